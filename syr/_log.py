@@ -8,7 +8,7 @@
     Functions that are used by both log and _log are here.
 
     Copyright 2015-2016 GoodCrypto
-    Last modified: 2016-05-24
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
@@ -44,11 +44,20 @@ def log(message, filename=None, mode=None):
             if not is_string(message):
                 logfile.write('{} {}\n'.format(timestamp(), message.decode(errors='replace')))
 
+# user names by effective uid, so whoami() doesn't read the passwd db every call
+_user_names = {}
+
 def whoami():
     ''' Get user '''
 
     # without using syr.user.whoami()
-    return pwd.getpwuid(os.geteuid()).pw_name
+    euid = os.geteuid()
+    try:
+        user = _user_names[euid]
+    except KeyError:
+        user = pwd.getpwuid(euid).pw_name
+        _user_names[euid] = user
+    return user
 
 def timestamp():
     ''' Timestamp as a string. Duplicated in this module to avoid recursive
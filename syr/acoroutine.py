@@ -0,0 +1,371 @@
+'''
+    asyncio coroutine graphs.
+
+    (Python 3 only.) AsyncCoroutine is like syr.coroutine.Coroutine,
+    but each node runs as its own asyncio task with its own bounded
+    queue. A syr.coroutine.Coroutine pushes each object depth first
+    through all its sinks before it takes the next object, so one slow
+    sink stalls every producer. Here a node sends to all its sinks at
+    once, and a producer only waits when a sink's queue is full.
+
+    Copyright 2026 GoodCrypto
+    Last modified: 2026-10-16
+
+    This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+import inspect
+
+from syr.iter import iter
+from syr.log import get_log
+from syr.python import last_exception
+
+log = get_log()
+
+# default maximum objects waiting in each node's queue
+DEFAULT_QUEUE_SIZE = 100
+
+# end of stream marker sent from a node to its sinks
+_STOP = object()
+
+class AsyncCoroutine(object):
+    ''' asyncio based coroutine with piping, broadcasting, and aggregating.
+
+        Override receive() to process received data. receive() may be a
+        coroutine function or a plain function. What receive() returns is
+        sent to every sink at the same time.
+
+        Pass objects to a node with "await node.send(object)". The node
+        and all its sinks start as tasks on the running event loop when
+        first sent an object. send() waits while the node's queue is full,
+        so fast producers slow down to match slow consumers.
+
+        When there is no more data, "await node.close()" on each node
+        with no sources. A node stops after it has processed everything
+        queued and every source has stopped. Then it calls after() and
+        stops its sinks. close() returns when every node downstream has
+        stopped. cancel() stops the nodes at once, and still calls after().
+
+        An exception from receive() is logged and counted in stats(), and
+        the node goes on. Any other exception in a node, e.g. from
+        filter(), fails the node. A failed node drops everything sent to
+        it, so its sources never wait on it, and stops as usual when its
+        sources stop. close() then raises the exception.
+
+        stats() returns counters for the node. See stats().
+
+        As with Coroutine, sending back to a node that sends to you raises
+        a ValueError.
+
+        >>> class Double(AsyncCoroutine):
+        ...     async def receive(self, object):
+        ...         return object * 2
+
+        >>> class Collect(AsyncCoroutine):
+        ...     def before(self):
+        ...         self.objects = []
+        ...     def receive(self, object):
+        ...         self.objects.append(object)
+        ...     def after(self):
+        ...         print('{} collected {}'.format(self.name(), self.objects))
+
+        >>> async def main():
+        ...     double = Double('double')
+        ...     collect = Collect('collect', sources=double)
+        ...     for i in range(3):
+        ...         await double.send(i)
+        ...     await double.close()
+        ...     return double.stats()['received']
+        >>> asyncio.run(main())
+        collect collected [0, 2, 4]
+        3
+
+        >>> class Fussy(AsyncCoroutine):
+        ...     def filter(self, object):
+        ...         raise ValueError('no {}'.format(object))
+
+        >>> async def fail():
+        ...     double = Double('double', queue_size=2)
+        ...     fussy = Fussy('fussy', sources=double, queue_size=2)
+        ...     collect = Collect('collect', sources=fussy)
+        ...     for i in range(1, 10):
+        ...         await double.send(i)
+        ...     await double.close()
+        >>> asyncio.run(fail())
+        Traceback (most recent call last):
+        ...
+        ValueError: no 2
+    '''
+
+    def __init__(self, name=None, sources=None, sinks=None, queue_size=DEFAULT_QUEUE_SIZE,
+                 *args, **kwargs):
+        ''' A source is another node which sends its output to this node.
+            The arg 'sources' may be a single source.
+
+            A sink is another node which gets its input from this node.
+            The arg 'sinks' may be a single sink.
+
+            'queue_size' is the maximum number of objects waiting for this node.
+
+            Call before() before all other processsing. '''
+
+        self._name = name
+        self.queue_size = queue_size
+        self.queue = None
+        self.task = None
+        self.source_count = 0
+
+        self.sinks = []
+        for sink in iter(sinks):
+            self.add_sink(sink)
+
+        for source in iter(sources):
+            source.add_sink(self)
+
+        self.received = 0
+        self.filtered = 0
+        self.sent = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.started_at = None
+        self.stopped_at = None
+        self.running = False
+        # the exception that failed this node, if any
+        self.error = None
+
+        self.before(*args, **kwargs)
+
+    def name(self):
+        return self._name or 'unknown'
+
+    def before(self, *args, **kwargs):
+        ''' Override this function to perform any one time setup.
+
+            Do what you'd ordinarily do in __init__. '''
+        pass
+
+    def after(self):
+        ''' Override this function to perform any one time cleanup.
+
+            Called once when the node stops, even if it was cancelled. '''
+        pass
+
+    def filter(self, object):
+        ''' Returns True if the object passes this filter. Otherwise returns False.
+
+            Only objects that pass filter() are sent to receive().
+            The default is to pass all objects. '''
+
+        return True
+
+    def receive(self, object):
+        ''' Override this function to perform any processing on an object.
+
+            May be a coroutine function. '''
+
+        return object
+
+    def add_sink(self, sink):
+        ''' Add a sink safely.
+
+            Looped data pipes raise a ValueError. '''
+
+        def check(sinks):
+            for sink in sinks:
+                if sink == self:
+                    path.append(self.name())
+                    raise ValueError('path exists from sink to self: -> {}'.format(path))
+                else:
+                    path.append(sink.name())
+                    check(sink.sinks)
+
+        if sink == self:
+            raise ValueError('sink for {} is self'.format(self.name()))
+        else:
+            path = [self.name(), sink.name()]
+            check(sink.sinks)
+
+        self.sinks.append(sink)
+        sink.source_count += 1
+
+    def start(self):
+        ''' Start this node and its sinks as tasks on the running event loop. '''
+
+        if self.task is None:
+            loop = asyncio.get_running_loop()
+            self.queue = asyncio.Queue(self.queue_size)
+            self.started_at = loop.time()
+            self.task = asyncio.ensure_future(self._run())
+            for sink in self.sinks:
+                sink.start()
+
+    async def send(self, object):
+        ''' Send an object to this node. Waits while the node's queue is full.
+
+            If the node has failed, the object is dropped. '''
+
+        self.start()
+        if self.error is not None:
+            return
+        await self.queue.put(object)
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    async def close(self):
+        ''' Stop this node when it has processed everything queued, and
+            wait for every node downstream to stop.
+
+            Raises the first exception that failed a node, if any. '''
+
+        self.start()
+        await self.queue.put(_STOP)
+        await self.join()
+
+    def cancel(self):
+        ''' Stop this node and every node downstream now. '''
+
+        for node in self.downstream():
+            if node.task is not None:
+                node.task.cancel()
+                # a task cancelled before it runs never reaches _run()'s finally
+                if not node.running:
+                    node._stop()
+
+    async def join(self):
+        ''' Wait until this node and every node downstream has stopped.
+
+            Raises the first exception that failed a node, if any. '''
+
+        nodes = self.downstream()
+        tasks = [node.task for node in nodes if node.task is not None]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for node in nodes:
+            if node.error is not None:
+                raise node.error
+
+    def downstream(self):
+        ''' Return a list of this node and every node downstream. '''
+
+        nodes = []
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            if node not in nodes:
+                nodes.append(node)
+                pending.extend(node.sinks)
+        return nodes
+
+    def stats(self):
+        ''' Return a dict of this node's counters.
+
+            'received': objects received.
+            'filtered': objects that failed filter().
+            'sent': objects sent to sinks.
+            'errors': objects where receive() raised an exception.
+            'busy_seconds': total seconds in receive().
+            'mean_latency': mean seconds in receive() per object.
+            'throughput': objects received per second since the node started.
+            'queue_depth': objects waiting now.
+            'max_queue_depth': most objects waiting at once.
+        '''
+
+        if self.started_at is None:
+            throughput = None
+        else:
+            end = self.stopped_at
+            if end is None:
+                end = asyncio.get_event_loop().time()
+            elapsed = end - self.started_at
+            throughput = self.received / elapsed if elapsed else None
+
+        processed = self.received - self.filtered
+        return {
+            'name': self.name(),
+            'received': self.received,
+            'filtered': self.filtered,
+            'sent': self.sent,
+            'errors': self.errors,
+            'busy_seconds': self.busy_seconds,
+            'mean_latency': self.busy_seconds / processed if processed else None,
+            'throughput': throughput,
+            'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+            'max_queue_depth': self.max_queue_depth,
+            }
+
+    async def _run(self):
+        ''' Receive and process each object until every source stops.
+            Call after() after all other processsing. '''
+
+        self.running = True
+        loop = asyncio.get_running_loop()
+        stops = 0
+        try:
+            while True:
+                object = await self.queue.get()
+
+                if object is _STOP:
+                    stops += 1
+                    if stops >= max(1, self.source_count):
+                        break
+                    continue
+
+                if self.error is not None:
+                    # failed; keep taking objects so sources never wait on us
+                    continue
+
+                try:
+                    await self._process(object, loop)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    self.error = exc
+                    log(last_exception())
+
+            # a failed sink still takes objects, so this can't block forever
+            for sink in self.sinks:
+                await sink.queue.put(_STOP)
+
+        finally:
+            self._stop()
+
+    async def _process(self, object, loop):
+        ''' Filter and receive one object, and send the result to every sink. '''
+
+        self.received += 1
+        if not self.filter(object):
+            self.filtered += 1
+            return
+
+        start = loop.time()
+        try:
+            result = self.receive(object)
+            if inspect.isawaitable(result):
+                result = await result
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.errors += 1
+            log(last_exception())
+            return
+        finally:
+            self.busy_seconds += loop.time() - start
+
+        if self.sinks:
+            await asyncio.gather(*[sink.send(result) for sink in self.sinks])
+            self.sent += 1
+
+    def _stop(self):
+        ''' Record the stop time and call after(). '''
+
+        self.stopped_at = asyncio.get_event_loop().time()
+        try:
+            self.after()
+        except:
+            log(last_exception())
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
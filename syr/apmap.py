@@ -0,0 +1,122 @@
+'''
+    asyncio map().
+
+    (Python 3 only.) Like syr.pmap, but the work runs as tasks on an
+    asyncio event loop instead of in threads. For I/O bound work such as
+    thousands of http or certificate checks, a few tasks waiting on the
+    network are far cheaper than a thread per check.
+
+    Copyright 2026 GoodCrypto
+    Last modified: 2026-10-16
+
+    This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+import functools
+
+from syr.log import get_log
+
+log = get_log()
+
+# default maximum number of items worked on at once
+DEFAULT_CONCURRENCY = 100
+
+async def apmap(work_function, iterable, concurrency=DEFAULT_CONCURRENCY,
+                timeout=None, return_exceptions=False, executor=None):
+    ''' asyncio map(). Returns a list of results in input order.
+
+        'work_function' is a coroutine function, or a plain function. A plain
+        function runs in 'executor', by default the event loop's default
+        thread pool, so blocking code like syr.http_utils.check_response()
+        works too. Coroutine functions scale much further. For a plain
+        function no more items run at once than the executor has threads,
+        whatever 'concurrency' is, so pass an executor with more threads
+        if you need them.
+
+        At most 'concurrency' items are worked on at once. Items are read
+        from the iterable only as earlier items finish.
+
+        'timeout' is the maximum seconds for each item. An item that takes
+        longer gets asyncio.TimeoutError as its result. A coroutine function
+        is cancelled. A plain function can't be stopped, so it keeps
+        running, and keeps its executor thread, until it returns.
+
+        If return_exceptions is False, the default, the first exception
+        cancels the items still running and is raised. If True, an
+        exception is returned as that item's result.
+
+        If apmap() itself is cancelled, the items still running are cancelled.
+
+        >>> async def double(x):
+        ...     await asyncio.sleep(0)
+        ...     return x * 2
+        >>> asyncio.run(apmap(double, range(5), concurrency=2))
+        [0, 2, 4, 6, 8]
+    '''
+
+    loop = asyncio.get_running_loop()
+    items = enumerate(iterable)
+    results = {}
+    is_coroutine_function = asyncio.iscoroutinefunction(work_function)
+
+    async def run(item):
+        if is_coroutine_function:
+            awaitable = work_function(item)
+        else:
+            awaitable = loop.run_in_executor(executor, functools.partial(work_function, item))
+        if timeout is None:
+            return await awaitable
+        else:
+            return await asyncio.wait_for(awaitable, timeout)
+
+    async def worker():
+        # each worker takes the next item when it finishes one
+        for index, item in items:
+            try:
+                results[index] = await run(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                if return_exceptions:
+                    results[index] = exc
+                else:
+                    raise
+
+    workers = [asyncio.ensure_future(worker()) for i in range(max(1, concurrency))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        # let cancelled tasks finish cleaning up
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    return [results[index] for index in range(len(results))]
+
+def apmap_sync(work_function, iterable, **kwargs):
+    ''' Run apmap() from ordinary code. Returns a list of results.
+
+        Starts a new event loop, so don't call it from a coroutine. In a
+        coroutine, use "await apmap(...)". The keyword args are passed to apmap().
+
+        >>> import time
+        >>> def slow_double(x):
+        ...     time.sleep(0.01)
+        ...     return x * 2
+        >>> apmap_sync(slow_double, [1, 2, 3])
+        [2, 4, 6]
+
+        >>> async def slow(x):
+        ...     await asyncio.sleep(x)
+        ...     return x
+        >>> results = apmap_sync(slow, [0, 10], timeout=0.1, return_exceptions=True)
+        >>> results[0], type(results[1]).__name__
+        (0, 'TimeoutError')
+    '''
+
+    return asyncio.run(apmap(work_function, iterable, **kwargs))
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -11,6 +11,9 @@
     common functionality such as filters and one time processing. Very
     memory efficient implementation.
 
+    For a graph of coroutines that run concurrently on an asyncio
+    event loop, see syr.acoroutine.
+
     Some functions are from:
       * Dave Beasley's Generator Tricks for System Programers
         http://www.dabeaz.com/generators-uk/
@@ -18,7 +21,7 @@
         http://paddy3118.blogspot.com/2009/05/pipe-fitting-with-python-generators.html
 
     Portions Copyright 2012-2016 GoodCrypto
-    Last modified: 2016-05-01
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
@@ -31,6 +34,10 @@ if IS_PY2:
     from Queue import Queue
 else:
     from queue import Queue
+from collections import deque
+from itertools import islice
+import multiprocessing, multiprocessing.pool
+import threading, time
 
 from syr.python import last_exception, last_exception_only, object_name
 from syr.utils import synchronized
@@ -41,6 +48,10 @@ from syr.log import get_log
 log = get_log('/tmp/coroutine.log')
 debug = True
 
+# collect StageStats for every Pump and Coroutine. To instrument just
+# one, pass it instrument=True.
+INSTRUMENT = False
+
 def consumer(func):
     ''' Co-routine consumer decorator.
 
@@ -106,6 +117,158 @@ def pull(iterator):
     for item in iterator:
         pass
 
+class StageStats(object):
+    ''' Counters for one stage of a pipeline.
+
+        'items' is the number of objects into the stage, 'filtered' the
+        number removed by filters, and 'seconds' the total time in
+        process() or receive().
+    '''
+
+    def __init__(self, name, queue_depth=None):
+        ''' 'queue_depth' is an optional function that returns the
+            number of objects waiting in the stage. '''
+
+        self.name = name
+        self.queue_depth = queue_depth
+        self.items = 0
+        self.filtered = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add_seconds(self, seconds):
+        ''' Add time spent processing. Safe to call from worker threads. '''
+
+        with self.lock:
+            self.seconds += seconds
+
+    def timed(self, function):
+        ''' Return function wrapped to add its run time to these stats. '''
+
+        def timed_function(*args):
+            start = time.time()
+            try:
+                return function(*args)
+            finally:
+                self.add_seconds(time.time() - start)
+
+        return timed_function
+
+    def counted_filter(self, filter, count_items=False):
+        ''' Return filter wrapped to count the objects it removes.
+
+            If count_items is True, also count the objects into the stage. '''
+
+        def counted(object):
+            if count_items:
+                self.items += 1
+            if filter(object):
+                return True
+            else:
+                self.filtered += 1
+                return False
+
+        return counted
+
+    def snapshot(self):
+        ''' Return a dict of the current counters. '''
+
+        return {
+            'name': self.name,
+            'items': self.items,
+            'filtered': self.filtered,
+            'seconds': self.seconds,
+            'mean_seconds': self.seconds / self.items if self.items else None,
+            'queue_depth': self.queue_depth() if self.queue_depth else None,
+            }
+
+def pipeline_stats(stage):
+    ''' Return a list of snapshots of StageStats for an instrumented pipeline.
+
+        For a Pump, 'stage' is the last Pump and the list is in order from
+        the first Pump. For a Coroutine, 'stage' is the first Coroutine
+        and the list includes every Coroutine downstream. Stages that are
+        not instrumented are skipped.
+
+        >>> class Double(Pump):
+        ...     def process(self, object):
+        ...         return object * 2
+
+        >>> class Even(Pump):
+        ...     def before_filter(self, object):
+        ...         return object % 2 == 0
+
+        >>> pump = Even(Double(iter(range(5)), instrument=True), instrument=True)
+        >>> list(pump)
+        [0, 2, 4, 6, 8]
+        >>> [(stats['name'], stats['items'], stats['filtered']) for stats in pipeline_stats(pump)]
+        [('Double', 5, 0), ('Even', 5, 0)]
+    '''
+
+    snapshots = []
+
+    if isinstance(stage, Coroutine):
+        stages = []
+        pending = [stage]
+        while pending:
+            coroutine = pending.pop(0)
+            if coroutine not in stages:
+                stages.append(coroutine)
+                pending.extend(coroutine.sinks)
+        for coroutine in stages:
+            if coroutine.stage_stats is not None:
+                snapshots.append(coroutine.stage_stats.snapshot())
+
+    else:
+        while isinstance(stage, Pump):
+            if stage.stage_stats is not None:
+                snapshots.insert(0, stage.stage_stats.snapshot())
+            stage = stage.upstream
+
+    return snapshots
+
+def pipeline_report(stage):
+    ''' Return a report of pipeline_stats(stage) as a string, one line per stage.
+
+        The stage with the most time in process() or receive() is the
+        likely bottleneck. It is marked with '*'.
+
+        >>> class Slow(Pump):
+        ...     def process(self, object):
+        ...         time.sleep(0.01)
+        ...         return object
+
+        >>> pump = Count(Slow(iter(range(3)), instrument=True), instrument=True)
+        >>> pull(pump)
+        >>> print(pipeline_report(pump)) # doctest: +ELLIPSIS, +NORMALIZE_WHITESPACE
+        stage items filtered seconds mean ms queue
+        Slow 3 0 0.0... ... -
+        Count 3 0 0.0... ... -
+        * Slow
+    '''
+
+    snapshots = pipeline_stats(stage)
+    lines = ['{:<20} {:>8} {:>9} {:>9} {:>8} {:>6}'.format(
+        'stage', 'items', 'filtered', 'seconds', 'mean ms', 'queue')]
+    for stats in snapshots:
+        if stats['mean_seconds'] is None:
+            mean = '-'
+        else:
+            mean = '{:.3f}'.format(stats['mean_seconds'] * 1000)
+        if stats['queue_depth'] is None:
+            queue_depth = '-'
+        else:
+            queue_depth = stats['queue_depth']
+        lines.append('{:<20} {:>8} {:>9} {:>9.4f} {:>8} {:>6}'.format(
+            stats['name'][:20], stats['items'], stats['filtered'], stats['seconds'],
+            mean, queue_depth))
+
+    if snapshots:
+        slowest = max(snapshots, key=lambda stats: stats['seconds'])
+        lines.append('* {}'.format(slowest['name']))
+
+    return '\n'.join(lines)
+
 class Pump(object):
     ''' A Pump is a data processsing station on a python pipeline.
         A pump can include filters, modify data items, and do one
@@ -201,10 +364,21 @@ class Pump(object):
     def __init__(self, iterable, *args, **kwargs):
         ''' Initialize the pipe. Call before() before all other processsing. '''
 
+        instrument = kwargs.pop('instrument', INSTRUMENT)
+
+        # the iterable as passed, for pipeline_stats()
+        self.upstream = iterable
+        if isinstance(iterable, BatchPump) and not isinstance(self, BatchPump):
+            # an item pump after a batch pump gets items
+            iterable = from_batches(iterable)
         self.source = iterable
         #if debug: log('iterable: {iterable}, self.source: {source!r}'.format(iterable=iterable, source=self.source))
         self.before(*args, **kwargs)
 
+        self.stage_stats = None
+        if instrument:
+            self.instrument()
+
     def __iter__(self):
         return self
 
@@ -294,6 +468,22 @@ class Pump(object):
 
         return object
 
+    def instrument(self):
+        ''' Collect StageStats for this pump in self.stage_stats.
+
+            Wraps this instance's filters and process(), so a pump that is
+            not instrumented has no overhead. '''
+
+        stats = self.stage_stats = StageStats(type(self).__name__, self.queue_depth)
+        self.before_filter = stats.counted_filter(self.before_filter, count_items=True)
+        self.process = stats.timed(self.process)
+        self.after_filter = stats.counted_filter(self.after_filter)
+
+    def queue_depth(self):
+        ''' Number of objects waiting in this pump, or None if the pump has no queue. '''
+
+        return None
+
     def __getattr__(self, name):
         ''' Pass anything else to the iterable. '''
 
@@ -362,6 +552,380 @@ class Count(Pump):
         setattr(self, self.attribute, getattr(self, self.attribute) + 1)
         return object
 
+def to_batches(iterable, size):
+    ''' Yield lists of up to 'size' items from iterable.
+
+        >>> list(to_batches(range(5), 2))
+        [[0, 1], [2, 3], [4]]
+    '''
+
+    items = iter(iterable)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+def from_batches(batches):
+    ''' Yield each item from an iterable of batches.
+
+        >>> list(from_batches([[0, 1], [2]]))
+        [0, 1, 2]
+    '''
+
+    for batch in batches:
+        for item in batch:
+            yield item
+
+class BatchPump(Pump):
+    ''' A Pump that handles a batch of objects at a time.
+
+        A Pump calls before_filter(), process(), and after_filter() for
+        every object. When the work per object is small, those calls cost
+        more than the work. A BatchPump gets a list of up to 'batch_size'
+        objects and calls process_batch() once for the whole list. With
+        NumPy, process_batch() can e.g. convert the list to an array and
+        use vectorized operations.
+
+        A BatchPump emits batches. Batch and item pumps connect
+        automatically. A BatchPump with an item source batches it, and a
+        Pump with a BatchPump source gets single items.
+
+        Override process_batch() instead of process(). The batch versions
+        of the filters, before_filter_batch() and after_filter_batch(),
+        return the batch with unwanted objects removed. By default they
+        use before_filter() and after_filter(), but only if you override
+        those. Empty batches are not emitted.
+
+        'batch_size' is a keyword arg, which is not passed to before().
+        The default is BatchPump.batch_size.
+
+        >>> class Double(BatchPump):
+        ...     def process_batch(self, batch):
+        ...         return [object * 2 for object in batch]
+
+        >>> list(Double(iter(range(5)), batch_size=2))
+        [[0, 2], [4, 6], [8]]
+        >>> list(Double(iter([0]), batch_size=1))
+        [[0]]
+
+        An item pump after a batch pump gets single items.
+        >>> list(Count(Double(iter(range(5)), batch_size=2)))
+        [0, 2, 4, 6, 8]
+
+        >>> counter = BatchCount(Double(iter(range(5))))
+        >>> batches = list(counter)
+        >>> counter.count
+        5
+    '''
+
+    batch_size = 100
+
+    def __init__(self, iterable, *args, **kwargs):
+        ''' Initialize the pipe. Call before() before all other processsing. '''
+
+        self.batch_size = kwargs.pop('batch_size', BatchPump.batch_size)
+        upstream = iterable
+        if not isinstance(iterable, BatchPump):
+            iterable = to_batches(iterable, self.batch_size)
+        super(BatchPump, self).__init__(iterable, *args, **kwargs)
+        self.upstream = upstream
+
+        # skip per object filter calls unless a subclass defines the filter
+        self._filter_before = type(self).before_filter is not Pump.before_filter
+        self._filter_after = type(self).after_filter is not Pump.after_filter
+
+    def __next__(self):
+        ''' Get and process the next batch. '''
+
+        try:
+            # test len(), not truth, so arrays and batches like [0] work
+            batch = ()
+            while len(batch) == 0:
+                batch = next(self.source)
+                batch = self.before_filter_batch(batch)
+                if len(batch):
+                    batch = self.process_batch(batch)
+                    batch = self.after_filter_batch(batch)
+
+        except (StopIteration, GeneratorExit):
+            # any exception before raise will hide StopIteration
+            try:
+                self.after()
+            except:
+                log(last_exception())
+            raise
+
+        return batch
+
+    # python 2
+    next = __next__
+
+    def instrument(self):
+        ''' Collect StageStats for this pump in self.stage_stats.
+
+            Counts objects, not batches. '''
+
+        stats = self.stage_stats = StageStats(type(self).__name__, self.queue_depth)
+        before_filter_batch = self.before_filter_batch
+        after_filter_batch = self.after_filter_batch
+
+        def counted_before_filter_batch(batch):
+            stats.items += len(batch)
+            filtered_batch = before_filter_batch(batch)
+            stats.filtered += len(batch) - len(filtered_batch)
+            return filtered_batch
+
+        def counted_after_filter_batch(batch):
+            filtered_batch = after_filter_batch(batch)
+            stats.filtered += len(batch) - len(filtered_batch)
+            return filtered_batch
+
+        self.before_filter_batch = counted_before_filter_batch
+        self.process_batch = stats.timed(self.process_batch)
+        self.after_filter_batch = counted_after_filter_batch
+
+    def before_filter_batch(self, batch):
+        ''' Returns the batch without objects that fail before_filter(). '''
+
+        if self._filter_before:
+            batch = [object for object in batch if self.before_filter(object)]
+        return batch
+
+    def after_filter_batch(self, batch):
+        ''' Returns the batch without objects that fail after_filter(). '''
+
+        if self._filter_after:
+            batch = [object for object in batch if self.after_filter(object)]
+        return batch
+
+    def process_batch(self, batch):
+        ''' Process a batch of objects. Returns the processed batch.
+
+            The default calls process() for each object, unless process()
+            is not overridden, in which case the batch is returned unchanged. '''
+
+        if type(self).process is Pump.process:
+            return batch
+        else:
+            return [self.process(object) for object in batch]
+
+class BatchCount(BatchPump):
+    ''' Count, one batch at a time.
+
+        The count is the number of items iterated over so far.
+    '''
+
+    def before(self, attribute=None, *args, **kwargs):
+        ''' Initialize the counter.
+
+            'attribute' is the count attribute, by default 'count'. '''
+
+        self.attribute = attribute or 'count'
+        setattr(self, self.attribute, 0)
+
+    def process_batch(self, batch):
+        ''' Count. '''
+
+        setattr(self, self.attribute, getattr(self, self.attribute) + len(batch))
+        return batch
+
+def _call_process(process, object):
+    ''' Call process(object) in a ParallelPump worker.
+
+        Returns (True, result), or (False, exception) if process() raised one. '''
+
+    try:
+        return True, process(object)
+    except Exception as exc:
+        return False, exc
+
+class ParallelPump(Pump):
+    ''' A Pump that runs process() on a pool of workers.
+
+        Use ParallelPump for a slow stage in a pipeline, so the rest of
+        the pipeline doesn't wait on it one object at a time. Subclass it
+        just like Pump.
+
+        before(), before_filter(), and after_filter() run in the calling
+        thread, in order. Only process() runs in the workers, so process()
+        must be thread safe, or process safe with processes=True. after()
+        runs once, after every object in flight is done and the pool is
+        closed.
+
+        Keyword args, which are not passed to before():
+            workers: Number of workers. Default is 4.
+            max_in_flight: Maximum objects being processed at once.
+                           Default is twice workers.
+            ordered: If True, the default, objects come out in the order
+                     they went in. If False, they come out as they are done.
+            processes: If True, workers are processes instead of threads,
+                       so cpu bound work can use every core. process() must
+                       then be a staticmethod of a class defined at module
+                       level, and objects must be picklable.
+
+        If process() raises an exception, the exception is raised from
+        the pump.
+
+        If you stop iterating early, call close(), or use the pump as a
+        context manager, to stop the pool and call after(). Otherwise that
+        waits until the pump is garbage collected.
+
+        When instrumented, queue depth is the number of objects in flight.
+        With processes=True the time in process() is not measured.
+
+        >>> class Square(ParallelPump):
+        ...     def before(self, *args, **kwargs):
+        ...         self.count = 0
+        ...     def before_filter(self, object):
+        ...         return object != 3
+        ...     def process(self, object):
+        ...         return object * object
+        ...     def after_filter(self, object):
+        ...         self.count += 1
+        ...         return True
+        ...     def after(self):
+        ...         print('squared {}'.format(self.count))
+
+        >>> list(Square(range(6), workers=3))
+        squared 5
+        [0, 1, 4, 16, 25]
+
+        >>> sorted(Square(range(6), workers=3, ordered=False))
+        squared 5
+        [0, 1, 4, 16, 25]
+
+        >>> with Square(range(100), workers=3) as squares:
+        ...     for square in squares:
+        ...         break
+        squared 1
+    '''
+
+    def __init__(self, iterable, *args, **kwargs):
+        ''' Initialize the pipe. Call before() before all other processsing. '''
+
+        self.workers = kwargs.pop('workers', 4)
+        self.max_in_flight = kwargs.pop('max_in_flight', None) or 2 * self.workers
+        self.ordered = kwargs.pop('ordered', True)
+        self.processes = kwargs.pop('processes', False)
+
+        self.pool = None
+        self.source_done = False
+        self.finished = False
+        # ordered: deque of AsyncResult
+        # unordered: count of objects in flight, with results in self.done
+        self.in_flight = deque()
+        self.in_flight_count = 0
+        self.done = Queue()
+
+        super(ParallelPump, self).__init__(iter(iterable), *args, **kwargs)
+        self.upstream = iterable
+
+    def __next__(self):
+        ''' Get the next processed object. '''
+
+        if self.finished:
+            raise StopIteration
+
+        if self.pool is None:
+            if self.processes:
+                self.pool = multiprocessing.Pool(self.workers)
+            else:
+                self.pool = multiprocessing.pool.ThreadPool(self.workers)
+
+        try:
+            while True:
+                self.fill()
+
+                if self.ordered:
+                    if not self.in_flight:
+                        raise StopIteration
+                    ok, object = self.in_flight.popleft().get()
+                else:
+                    if not self.in_flight_count:
+                        raise StopIteration
+                    ok, object = self.done.get()
+                    self.in_flight_count -= 1
+
+                if not ok:
+                    raise object
+
+                if self.after_filter(object):
+                    return object
+
+        except BaseException:
+            self.finish()
+            raise
+
+    # python 2
+    next = __next__
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        # __getattr__() passes missing attributes to the source, so check
+        # __dict__ in case __init__() did not finish
+        if not self.__dict__.get('finished', True):
+            self.close()
+
+    def close(self):
+        ''' Stop the pool and call after(), if not already done. '''
+
+        self.finish()
+
+    def instrument(self):
+        ''' Collect StageStats for this pump in self.stage_stats. '''
+
+        super(ParallelPump, self).instrument()
+        if self.processes:
+            # the timing wrapper can't be pickled
+            del self.process
+
+    def queue_depth(self):
+        ''' Number of objects in flight. '''
+
+        return len(self.in_flight) + self.in_flight_count
+
+    def fill(self):
+        ''' Send objects from the source to the pool until max_in_flight are in flight. '''
+
+        while (not self.source_done and
+               len(self.in_flight) + self.in_flight_count < self.max_in_flight):
+
+            try:
+                object = next(self.source)
+            except StopIteration:
+                self.source_done = True
+            else:
+                if self.before_filter(object):
+                    if self.ordered:
+                        self.in_flight.append(
+                            self.pool.apply_async(_call_process, (self.process, object)))
+                    else:
+                        self.pool.apply_async(
+                            _call_process, (self.process, object),
+                            callback=self.done.put,
+                            # e.g. the object could not be pickled
+                            error_callback=lambda exc: self.done.put((False, exc)))
+                        self.in_flight_count += 1
+
+    def finish(self):
+        ''' Close the pool and call after(), once. '''
+
+        if not self.finished:
+            self.finished = True
+            if self.pool is not None:
+                # objects still in flight are abandoned if we stopped early
+                self.pool.terminate()
+                self.pool.join()
+            try:
+                self.after()
+            except:
+                log(last_exception())
+
 class Coroutine(object):
     ''' Generator based coroutine with piping, broadcasting, and aggregating.
 
@@ -457,8 +1021,14 @@ class Coroutine(object):
         for source in iter(sources):
             source.add_sink(self)
 
+        instrument = kwargs.pop('instrument', INSTRUMENT)
+
         self.before(*args, **kwargs)
 
+        self.stage_stats = None
+        if instrument:
+            self.instrument()
+
         self.running = True
         self._c_loop = self._loop()
         if IS_PY2:
@@ -533,6 +1103,28 @@ class Coroutine(object):
 
         self.running = False
 
+    def instrument(self):
+        ''' Collect StageStats for this coroutine in self.stage_stats.
+
+            Wraps this instance's filter() and receive(), so a coroutine
+            that is not instrumented has no overhead. A Coroutine has
+            no queue, so queue depth is None. See pipeline_report().
+
+            >>> class Odd(Coroutine):
+            ...     def filter(self, object):
+            ...         return object % 2
+            >>> first = Coroutine('first', instrument=True)
+            >>> odd = Odd('odd', sources=first, instrument=True)
+            >>> for i in range(5):
+            ...     first.send(i)
+            >>> [(stats['name'], stats['items'], stats['filtered']) for stats in pipeline_stats(first)]
+            [('first', 5, 0), ('odd', 5, 3)]
+        '''
+
+        stats = self.stage_stats = StageStats(self.name())
+        self.filter = stats.counted_filter(self.filter, count_items=True)
+        self.receive = stats.timed(self.receive)
+
     def add_sink(self, sink):
         ''' Add a sink safely.
 
@@ -555,11 +1147,19 @@ class Coroutine(object):
 
         self.sinks.add(sink)
 
-def Coiterator(Coroutine):
+class Coiterator(Coroutine):
     ''' Coroutine that is an iterator.
 
         The items you send() to a Coiterator are produced as
-        iterator items. '''
+        iterator items.
+
+        >>> coiterator = Coiterator()
+        >>> for i in range(3):
+        ...     coiterator.send(i)
+        >>> coiterator.done = True
+        >>> list(coiterator)
+        [0, 1, 2]
+        '''
 
     def before(self, block=False, *args, **kwargs):
         ''' One time setup. '''
@@ -588,13 +1188,15 @@ def Coiterator(Coroutine):
     def next(self):
         ''' Get and process the next item.
             Block until an object is available.
-            Raise StopIteration if the source is done. '''
+            Raise StopIteration if the source is done and no items are left. '''
 
-        if self.done:
+        if self.done and self.q.empty():
             raise StopIteration
         else:
             return self.q.get(True)
 
+    __next__ = next
+
 if __name__ == "__main__":
 
     import doctest
@@ -5,7 +5,7 @@
     Dave Beasley's Generator Functions for System Programers.
 
     Portions Copyright 2011-2016 GoodCrypto
-    Last modified: 2016-08-01
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
@@ -18,9 +18,10 @@ if IS_PY2:
     import __builtin__
 else:
     import builtins
-from itertools import takewhile
+from itertools import islice, takewhile
 from threading import Event, Thread
 from time import sleep
+import pickle, socket, struct
 
 from syr.log import get_log
 
@@ -127,7 +128,39 @@ def last_true(iterable):
             last_true_item = item
     return last_true_item
 
-def enqueue(q, *iterables):
+class EndOfStream(object):
+    ''' Marks the end of items from enqueue().
+
+        Unlike a sentinel object(), it can be pickled, so it still marks
+        the end after it is sent to another process. Every EndOfStream
+        is equal to every other.
+
+        >>> pickle.loads(pickle.dumps(END_OF_STREAM)) == END_OF_STREAM
+        True
+    '''
+
+    def __eq__(self, other):
+        return isinstance(other, EndOfStream)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(EndOfStream)
+
+    def __repr__(self):
+        return 'END_OF_STREAM'
+
+END_OF_STREAM = EndOfStream()
+
+class Batch(list):
+    ''' A list of items that enqueue() sends as one queue item.
+
+        dequeue() yields the items one at a time. '''
+
+    pass
+
+def enqueue(q, *iterables, **kwargs):
     ''' Queue items from one or more iterables.
 
         You can enqueue() items in one thread, and dequeue() them from another.
@@ -136,12 +169,24 @@ def enqueue(q, *iterables):
         if necessary time.sleep(). Set up the thread that calls dequeue(),
         then call enqueue(). See the doctest example.
 
-        StopIteration can not be an item from one of the iterables, which is
-        vanishingly unlikely anyway.
+        The queue can be anything with put() and get(), such as a
+        Queue, a multiprocessing.Queue, or a SocketQueue. So the thread
+        that calls dequeue() can be in another process. Items must then
+        be picklable.
+
+        Each put() to a queue between processes has to pickle and send
+        the item. The keyword arg 'batch_size' sends up to that many
+        items in each put(), which is much faster for small items. The
+        default is 1.
+
+        The end of the items is marked with END_OF_STREAM.
 
         Thanks to Dave Beasley.
 
-        >>> from Queue import Queue
+        >>> if IS_PY2:
+        ...     from Queue import Queue
+        ... else:
+        ...     from queue import Queue
 
         >>> iter1 = (1, 2)
         >>> iter2 = [3, 4]
@@ -168,14 +213,34 @@ def enqueue(q, *iterables):
         2
         3
         4
-
+        True
+
+        Between processes.
+        >>> import multiprocessing
+        >>> q = multiprocessing.Queue()
+        >>> process = multiprocessing.Process(target=enqueue, args=(q, range(5)),
+        ...                                   kwargs={'batch_size': 2})
+        >>> process.start()
+        >>> list(dequeue(q))
+        [0, 1, 2, 3, 4]
+        >>> process.join()
         '''
 
+    batch_size = kwargs.pop('batch_size', 1)
+    if kwargs:
+        raise TypeError('unexpected keyword args: {}'.format(', '.join(kwargs)))
+
     for iterable in iterables:
-        for item in iterable:
-            q.put(item)
-    # will this work across net links? python instances on a machine?
-    q.put(StopIteration)
+        if batch_size > 1:
+            items = iter(iterable)
+            batch = Batch(islice(items, batch_size))
+            while batch:
+                q.put(batch)
+                batch = Batch(islice(items, batch_size))
+        else:
+            for item in iterable:
+                q.put(item)
+    q.put(END_OF_STREAM)
 
 def dequeue(q):
     ''' Get items that were queued using enqueue().
@@ -185,10 +250,103 @@ def dequeue(q):
         Thanks to Dave Beasley. '''
 
     item = q.get()
-    while item != StopIteration:
-        yield item
+    # StopIteration marked the end before END_OF_STREAM
+    while item != END_OF_STREAM and item != StopIteration:
+        if type(item) is Batch:
+            for batch_item in item:
+                yield batch_item
+        else:
+            yield item
         item = q.get()
 
+class SocketQueue(object):
+    ''' A queue over a socket, usually a unix domain socket.
+
+        Each item is pickled and sent with a 4 byte length prefix. One end
+        can put() while the other end calls get(). Use it with enqueue()
+        and dequeue() to split a pipeline between processes that don't
+        share a multiprocessing.Queue.
+
+        >>> producer, consumer = SocketQueue.pair()
+        >>> thread = Thread(target=enqueue, args=(producer, ['a', 'b', 'c']),
+        ...                 kwargs={'batch_size': 2})
+        >>> thread.start()
+        >>> list(dequeue(consumer))
+        ['a', 'b', 'c']
+        >>> thread.join()
+        >>> producer.close()
+        >>> consumer.get()
+        Traceback (most recent call last):
+        ...
+        EOFError: socket closed
+        >>> consumer.close()
+    '''
+
+    LENGTH = struct.Struct('>I')
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    @staticmethod
+    def pair():
+        ''' Return two connected SocketQueues, e.g. to share with a child process. '''
+
+        sock1, sock2 = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        return SocketQueue(sock1), SocketQueue(sock2)
+
+    @staticmethod
+    def connect(path):
+        ''' Return a SocketQueue connected to the unix domain socket at path. '''
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return SocketQueue(sock)
+
+    @staticmethod
+    def listen(path):
+        ''' Wait for a connection to the unix domain socket at path.
+            Return a SocketQueue for the connection.
+
+            The path must not exist yet. '''
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(path)
+            server.listen(1)
+            sock, address = server.accept()
+        finally:
+            server.close()
+        return SocketQueue(sock)
+
+    def put(self, item):
+        ''' Send an item. '''
+
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        self.sock.sendall(SocketQueue.LENGTH.pack(len(data)) + data)
+
+    def get(self):
+        ''' Wait for an item and return it.
+
+            Raises EOFError if the other end closed the socket. '''
+
+        length, = SocketQueue.LENGTH.unpack(self.recv(SocketQueue.LENGTH.size))
+        return pickle.loads(self.recv(length))
+
+    def recv(self, size):
+        ''' Receive exactly size bytes. '''
+
+        chunks = []
+        while size:
+            chunk = self.sock.recv(min(size, 1024 * 1024))
+            if not chunk:
+                raise EOFError('socket closed')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self.sock.close()
+
 if __name__ == "__main__":
 
     import doctest
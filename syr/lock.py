@@ -2,15 +2,21 @@
     Locked threading.Lock context.
 
     Copyright 2011-2016 GoodCrypto
-    Last modified: 2016-04-23
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
 from __future__ import unicode_literals
 
-import atexit, os, threading, traceback
+import errno, fcntl, os, threading, time, traceback
 from contextlib import contextmanager
-from os import O_CREAT, O_EXCL, O_RDWR
+from os import O_CREAT, O_RDONLY, O_RDWR
+
+# lock files are not inherited by programs we exec
+O_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+# longest wait between tries to get a system lock with a timeout, in seconds
+_MAX_RETRY_SECONDS = 0.05
 
 DEBUGGING = False
 def _debug(msg):
@@ -23,7 +29,7 @@ def _debug(msg):
         print(msg)
 
 @contextmanager
-def locked(lock=None, blocking=True):
+def locked(lock=None, blocking=True, name=None):
     ''' Context manager to acquire a lock.
 
         This is a lock within a process. See system_locked() for a system wide lock.
@@ -32,8 +38,21 @@ def locked(lock=None, blocking=True):
         This context manager enforces that restriction painlessly by
         calling release automatically for you.
 
+        If you pass a 'name', locked() records how long threads wait for
+        the lock, how long they hold it, and how often they find it
+        already locked. See lock_stats(). Without a name there is no
+        overhead.
+
         >>> with locked():
-        >>>     print 'this is a locked thread'
+        ...     print('this is a locked thread')
+        this is a locked thread
+
+        >>> lock = threading.Lock()
+        >>> with locked(lock, name='doctest'):
+        ...     lock_stats()['doctest']['acquisitions']
+        1
+        >>> lock_stats()['doctest']['contended']
+        0
     '''
 
     if not lock:
@@ -42,7 +61,11 @@ def locked(lock=None, blocking=True):
     _debug('acquiring lock')
     if DEBUGGING:
         traceback.print_stack()
-    lock.acquire(blocking)
+    if name is None:
+        lock.acquire(blocking)
+    else:
+        stats = _get_lock_stats(name)
+        acquired_at = stats.acquire(lock, blocking)
     _debug('lock acquired')
 
     try:
@@ -51,75 +74,460 @@ def locked(lock=None, blocking=True):
     finally:
         _debug('releasing lock')
         lock.release()
+        if name is not None:
+            stats.released(acquired_at)
         _debug('lock released')
 
+class LockStats(object):
+    ''' Wait time, hold time, and contention for one named lock. '''
+
+    def __init__(self, name):
+        self.name = name
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.hold_seconds = 0.0
+        self.max_hold_seconds = 0.0
+        # guards the counters
+        self.lock = threading.Lock()
+
+    def acquire(self, lock, blocking=True):
+        ''' Acquire lock, and record contention and wait time.
+
+            Returns the time the lock was acquired. '''
+
+        if lock.acquire(False):
+            wait = 0.0
+            contended = False
+        else:
+            contended = True
+            start = time.time()
+            lock.acquire(blocking)
+            wait = time.time() - start
+        acquired_at = time.time()
+
+        with self.lock:
+            self.acquisitions += 1
+            if contended:
+                self.contended += 1
+                self.wait_seconds += wait
+                if wait > self.max_wait_seconds:
+                    self.max_wait_seconds = wait
+
+        return acquired_at
+
+    def released(self, acquired_at):
+        ''' Record hold time for a lock acquired at 'acquired_at'. '''
+
+        hold = time.time() - acquired_at
+        with self.lock:
+            self.hold_seconds += hold
+            if hold > self.max_hold_seconds:
+                self.max_hold_seconds = hold
+
+    def snapshot(self):
+        ''' Return a dict of the current counters. '''
+
+        with self.lock:
+            return {
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'hold_seconds': self.hold_seconds,
+                'max_hold_seconds': self.max_hold_seconds,
+                }
+
+# LockStats by lock name
+_lock_stats = {}
+_lock_stats_lock = threading.Lock()
+
+def _get_lock_stats(name):
+    ''' Return the LockStats for name, creating it if needed. '''
+
+    try:
+        return _lock_stats[name]
+    except KeyError:
+        with _lock_stats_lock:
+            if name not in _lock_stats:
+                _lock_stats[name] = LockStats(name)
+            return _lock_stats[name]
+
+def lock_stats():
+    ''' Return a dict of LockStats snapshots by lock name. '''
+
+    with _lock_stats_lock:
+        stats = list(_lock_stats.values())
+    return {lock.name: lock.snapshot() for lock in stats}
+
+def lock_report():
+    ''' Return lock_stats() as a string, one line per lock, most total
+        wait time first. The locks at the top are the worst hotspots. '''
+
+    lines = ['{:<30} {:>10} {:>10} {:>10} {:>10}'.format(
+        'lock', 'acquired', 'contended', 'wait sec', 'hold sec')]
+    stats = sorted(lock_stats().items(), key=lambda item: item[1]['wait_seconds'], reverse=True)
+    for name, lock in stats:
+        lines.append('{:<30} {:>10} {:>10} {:>10.4f} {:>10.4f}'.format(
+            name[:30], lock['acquisitions'], lock['contended'],
+            lock['wait_seconds'], lock['hold_seconds']))
+    return '\n'.join(lines)
+
+def reset_lock_stats():
+    ''' Forget all lock stats. '''
+
+    with _lock_stats_lock:
+        _lock_stats.clear()
+
+class RWLock(object):
+    ''' Read/write lock.
+
+        Any number of threads can hold the read lock at once, but the
+        write lock is exclusive. Use it for data that is read much more
+        often than it is changed, like a cache.
+
+        Once a writer is waiting, new readers wait too, so a steady
+        stream of readers can't keep a writer out forever.
+
+        The locks are not reentrant. A thread that holds the read lock
+        must not ask for the read lock again, or for the write lock. If a
+        writer is waiting, the thread waits forever.
+
+        If 'name' is set, wait and hold times are recorded in lock_stats()
+        as 'NAME read' and 'NAME write'.
+
+        >>> lock = RWLock()
+        >>> with lock.read_locked():
+        ...     lock.readers
+        1
+        >>> with lock.write_locked():
+        ...     lock.writing
+        True
+
+        >>> results = benchmark_rwlock(threads=4, reads=50, read_seconds=0.001)
+        >>> results['rwlock'] < results['lock']
+        True
+    '''
+
+    def __init__(self, name=None):
+        self.name = name
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+
+        if name is None:
+            self.read_stats = self.write_stats = None
+        else:
+            self.read_stats = _get_lock_stats('{} read'.format(name))
+            self.write_stats = _get_lock_stats('{} write'.format(name))
+
+    def acquire_read(self, blocking=True):
+        ''' Wait until there are no writers and acquire the read lock.
+
+            If not blocking and there are writers, return False. '''
+
+        with self.condition:
+            while self.writing or self.writers_waiting:
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.readers += 1
+            return True
+
+    def release_read(self):
+        ''' Release the read lock. '''
+
+        with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self, blocking=True):
+        ''' Wait until there are no readers or writers and acquire the write lock.
+
+            If not blocking and there are readers or writers, return False. '''
+
+        with self.condition:
+            if not blocking and (self.writing or self.readers):
+                return False
+            self.writers_waiting += 1
+            try:
+                while self.writing or self.readers:
+                    self.condition.wait()
+            finally:
+                self.writers_waiting -= 1
+            self.writing = True
+            return True
+
+    def release_write(self):
+        ''' Release the write lock. '''
+
+        with self.condition:
+            self.writing = False
+            self.condition.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        ''' Context manager to acquire the read lock. '''
+
+        with self._locked(self.read_stats, self.acquire_read, self.release_read):
+            yield
+
+    @contextmanager
+    def write_locked(self):
+        ''' Context manager to acquire the write lock. '''
+
+        with self._locked(self.write_stats, self.acquire_write, self.release_write):
+            yield
+
+    @contextmanager
+    def _locked(self, stats, acquire, release):
+        if stats is None:
+            acquire()
+        else:
+            acquired_at = stats.acquire(_RWLockSide(acquire))
+        try:
+            yield
+        finally:
+            release()
+            if stats is not None:
+                stats.released(acquired_at)
+
+class _RWLockSide(object):
+    ''' Looks like a threading.Lock to LockStats.acquire(). '''
+
+    def __init__(self, acquire):
+        self._acquire = acquire
+
+    def acquire(self, blocking=True):
+        return self._acquire(blocking)
+
+def benchmark_rwlock(threads=8, reads=2000, read_seconds=0.0001):
+    ''' Compare an exclusive lock with an RWLock for read only threads.
+
+        Each read holds its lock for 'read_seconds'. Returns a dict of
+        total seconds for 'lock' and 'rwlock'.
+    '''
+
+    lock = threading.Lock()
+    rwlock = RWLock()
+
+    def read_with_lock():
+        for i in range(reads):
+            with locked(lock):
+                time.sleep(read_seconds)
+
+    def read_with_rwlock():
+        for i in range(reads):
+            with rwlock.read_locked():
+                time.sleep(read_seconds)
+
+    results = {}
+    for key, target in (('lock', read_with_lock), ('rwlock', read_with_rwlock)):
+        workers = [threading.Thread(target=target) for i in range(threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        results[key] = time.time() - start
+    return results
+
 @contextmanager
-def system_locked(name):
+def system_locked(name, blocking=False, timeout=None, shared=False):
     ''' Context manager to acquire a system wide lock.
 
-        !! A port might be a better lock.
-
         'name' is typically '__module__' or '__file__'.
 
         See locked() for a lock within a process.
 
         The name must only contain characters allowed in filenames.
 
-        Credit:
-            Miki Tebeka
-            <miki.tebeka at zoran.com>
-            http://tebeka.bizhat.com
-            http://mail.python.org/pipermail/python-win32/2005-February/002958.html
+        Yields True if the lock was acquired, else False.
+
+        By default system_locked() doesn't wait. If 'blocking' is True,
+        it waits until the lock is free, or for at most 'timeout' seconds.
+
+        If 'shared' is True, any number of processes can hold the lock at
+        once, but not while another process holds it exclusively. Use
+        shared locks for readers and exclusive locks for writers.
+
+        The lock is an fcntl.flock() on '/tmp/_NAME_.lock'. The operating
+        system releases the lock when the holder exits or dies, so an
+        abandoned lock file doesn't block anyone. The lock file is never
+        removed, because removing it would let two processes lock
+        different files with the same name. The file is readable and
+        writable by every user, so apps running as different users can
+        share the lock. If another user created the file without write
+        permission, it is locked read only. An exclusive holder that can
+        write the file writes its PID to it. See system_lock_holder().
+
+        Different threads in one process also exclude each other.
 
         >>> name = 'locktest'
         >>> with system_locked(name) as locked:
-        >>>     if locked:
-        >>>         print 'this is locked system wide'
-        >>>     else:
-        >>>         print 'another process or program has already locked %s' % name
+        ...     if locked:
+        ...         print('this is locked system wide')
+        ...     else:
+        ...         print('another process or program has already locked %s' % name)
+        this is locked system wide
+
+        >>> with system_locked(name) as locked:
+        ...     with system_locked(name, blocking=True, timeout=0.1) as locked_again:
+        ...         locked, locked_again
+        (True, False)
+
+        >>> with system_locked(name, shared=True) as locked:
+        ...     with system_locked(name, shared=True) as locked_again:
+        ...         locked, locked_again
+        (True, True)
+
+        >>> stress_test_system_locked(processes=4, increments=25)
+        100
         '''
 
-    def lock():
+    lockfile = system_lock_path(name)
+    try:
+        lockfd = os.open(lockfile, O_CREAT | O_RDWR | O_CLOEXEC, 0o666)
+    except OSError as exc:
+        if exc.errno != errno.EACCES:
+            raise
+        # another user's lock file; flock() works on a read only file
+        lockfd = os.open(lockfile, O_RDONLY | O_CLOEXEC)
+        writable = False
+    else:
+        writable = True
         try:
-            # try to remove any abandoned lockfile
-            os.remove(lockfile)
+            # os.open() applied the umask
+            os.fchmod(lockfd, 0o666)
         except OSError:
-            # no abandoned lockfile
+            # another user owns the file
             pass
 
-        try:
-            lockfd = os.open(lockfile, O_CREAT|O_EXCL|O_RDWR)
-            os.write(lockfd, '%d' % os.getpid())
-        except OSError: # Already locked
-            lockfd = None
+    try:
+        locked = _flock(lockfd, shared, blocking, timeout)
+        write_pid = locked and writable and not shared
+        if write_pid:
+            os.ftruncate(lockfd, 0)
+            os.write(lockfd, str(os.getpid()).encode())
 
-        return bool(lockfd)
+        try:
+            yield locked
+        finally:
+            if locked:
+                if write_pid:
+                    os.ftruncate(lockfd, 0)
+                fcntl.flock(lockfd, fcntl.LOCK_UN)
+    finally:
+        # closing the file would release the lock anyway
+        os.close(lockfd)
 
-    def unlock():
-        if lockfd:
-            try:
-                try:
-                    os.close(lockfd)
-                except:
-                    pass
-                os.remove(lockfile)
-                unlocked = True
-            except OSError:
-                unlocked = False
-        else:
-            unlocked = False
-        return unlocked
+def system_lock_path(name):
+    ''' Return the path of the lock file for system_locked(name). '''
 
     name = name.replace('/', '_').replace(' ', '_')
+    return '/tmp/_%s_.lock' % name
+
+def system_lock_holder(name):
+    ''' Return the PID of the process with an exclusive system_locked(name),
+        or None.
+
+        The PID in the lock file is stale if that process is gone, or
+        if the process is running and no longer has the lock. In either
+        case this returns None.
+
+        >>> with system_locked('locktest'):
+        ...     system_lock_holder('locktest') == os.getpid()
+        True
+        >>> print(system_lock_holder('locktest'))
+        None
+    '''
+
+    try:
+        with open(system_lock_path(name)) as lockfile:
+            pid = int(lockfile.read().strip() or 0)
+    except (IOError, OSError, ValueError):
+        pid = 0
+
+    if pid:
+        try:
+            os.kill(pid, 0)
+        except OSError as exc:
+            if exc.errno != errno.EPERM:
+                # no such process
+                pid = 0
+
+    if pid:
+        # the holder clears its PID when it unlocks. A PID left in the file
+        # by a process that is still running is stale if we can get the lock.
+        with system_locked(name, shared=True) as free:
+            if free:
+                pid = 0
+
+    return pid or None
+
+def _flock(lockfd, shared, blocking, timeout):
+    ''' Lock an open file. Return True if locked, else False. '''
+
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+
+    if blocking and timeout is None:
+        # the kernel wakes us when the lock is free
+        fcntl.flock(lockfd, operation)
+        return True
+
+    # flock() can't time out, so retry with a growing wait
+    deadline = time.time() + (timeout or 0)
+    wait = 0.001
+    while True:
+        try:
+            fcntl.flock(lockfd, operation | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError) as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        remaining = deadline - time.time()
+        if not blocking or remaining <= 0:
+            return False
+        time.sleep(min(wait, remaining))
+        wait = min(wait * 2, _MAX_RETRY_SECONDS)
+
+def _stress_test_worker(name, counter_path, increments):
+    ''' Increment the count in counter_path under system_locked(name). '''
+
+    for i in range(increments):
+        with system_locked(name, blocking=True) as locked:
+            assert locked
+            with open(counter_path) as counter:
+                count = int(counter.read())
+            with open(counter_path, 'w') as counter:
+                counter.write(str(count + 1))
+
+def stress_test_system_locked(processes=8, increments=100, name='system_locked_stress_test'):
+    ''' Have processes contend for system_locked(name), each incrementing
+        a counter in a file increments times. Returns the final count.
+
+        Without mutual exclusion, increments are lost and the count is
+        less than processes * increments.
+    '''
 
-    lockfile = '/tmp/_%s_.lock' % name
-    lockfd = None
+    import multiprocessing, tempfile
 
-    locked = lock()
+    fd, counter_path = tempfile.mkstemp()
+    os.write(fd, b'0')
+    os.close(fd)
     try:
-        if locked:
-            atexit.register(unlock)
-        yield locked
+        workers = [multiprocessing.Process(target=_stress_test_worker,
+                                           args=(name, counter_path, increments))
+                   for i in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        with open(counter_path) as counter:
+            return int(counter.read())
     finally:
-        if locked:
-            unlock()
+        os.remove(counter_path)
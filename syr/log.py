@@ -23,6 +23,13 @@ from __future__ import unicode_literals
     >>> log.info('informational message')
     >>> log('debugging message')
 
+    Arguments are only formatted if the message is logged, so pass
+    them instead of formatting them yourself.
+    >>> log.debug('debugging %s', 'message')
+    >>> log.set_level('INFO')
+    >>> log.debug('not formatted or written: %r', 'message')
+    >>> log.set_level('DEBUG')
+
     You can specify a log filename, which appears in the
     /var/local/log/USER directory.
     >>> log = get_log('special.log')
@@ -50,7 +57,7 @@ from __future__ import unicode_literals
         Log.info() can write to more than one log. (may be fixed)
 
     Copyright 2008-2016 GoodCrypto
-    Last modified: 2016-07-11
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
@@ -100,8 +107,13 @@ if IS_PY2:
     reload(sys)
     sys.setdefaultencoding('utf-8')
 
-import atexit, logging, os, os.path, pwd, sh, shutil, smtplib, stat, sys
+import atexit, fcntl, gzip, io, json, logging, os, os.path, pwd, sh, shutil, smtplib, stat, sys
 import tempfile, threading, time, traceback
+from contextlib import contextmanager
+if IS_PY2:
+    from Queue import Queue, Empty, Full
+else:
+    from queue import Queue, Empty, Full
 from threading import Thread
 from traceback import format_exc, format_stack
 from glob import glob
@@ -120,10 +132,47 @@ BASE_LOG_DIR = '/var/local/log'
 # you may need to create it in advance.
 BASE_LOG_DIR_PERMS = 0o777
 
+# Default log rotation, used when open() doesn't specify it.
+# ROTATE_MAX_BYTES is a size in bytes, and ROTATE_INTERVAL is in seconds.
+# None means don't rotate on that basis. Rotated logs are gzipped,
+# and ROTATE_KEEP rotated logs are kept for each log.
+ROTATE_MAX_BYTES = None
+ROTATE_INTERVAL = None
+ROTATE_KEEP = 5
+
+# Minimum level for new logs. Change a log's level with its set_level().
+DEFAULT_LEVEL = logging.DEBUG
+
+# If True, new logs write one JSON object per line instead of text.
+# See JsonLinesFormatter.
+STRUCTURED_LOGS = False
+
+_LEVELS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+    }
+
 logs = {}
 _master_logs = {}
 _use_master_log = True
 _raise_logging_errors = False
+# set by start_async(), cleared by stop_async()
+_async_writer = None
+# set by start_master_batching(), cleared by stop_master_batching()
+_master_batcher = None
+# started by the first log rotation
+_compressor = None
+
+# get_log_path() results, keyed by
+# (filename or caller's filename, dirname, BASE_LOG_DIR, effective uid)
+_log_paths = {}
+# log dirs known to exist
+_log_dirs = set()
+# source file for this module, to skip our own frames when finding the caller
+_this_file = __file__[:-1] if __file__.endswith(('.pyc', '.pyo')) else __file__
 
 # the log module cannot easily use logs itself
 # so _DEBUGGING turns alternate logging on and off
@@ -230,6 +279,108 @@ class CustomFileHandler(logging.FileHandler):
         '''
         raise
 
+class JsonLinesFormatter(logging.Formatter):
+    ''' Format each log record as one line of JSON.
+
+        Each object has 'timestamp', 'pid', 'thread', 'module', 'level',
+        'message', and 'exception'. 'module' is the log name, e.g.
+        'syr.net'. For a master log it is the name of the log the entry
+        came from.
+
+        'exception' is the traceback if the record has exc_info, or if the
+        message is a traceback, as from log(exception) in an except block
+        or log(last_exception()). Then 'message' is the traceback's last
+        line, e.g. "ValueError: bad value". Otherwise 'exception' is null.
+
+        One formatter instance serves every record. Each line is filled in
+        from a fixed template, and only the strings go through the json
+        module's C string encoder.
+
+        >>> record = logging.LogRecord('syr.test', logging.DEBUG, '', 0,
+        ...                            '- syr.net.log - INFO connected', None, None)
+        >>> entry = json.loads(JsonLinesFormatter().format(record))
+        >>> print(entry['module'], entry['level'], entry['message'])
+        syr.net INFO connected
+        >>> print(entry['exception'])
+        None
+
+        >>> try:
+        ...     raise ValueError('bad value')
+        ... except ValueError:
+        ...     message = 'DEBUG ' + traceback.format_exc()
+        >>> record = logging.LogRecord('syr.test', logging.DEBUG, '', 0,
+        ...                            message, None, None)
+        >>> entry = json.loads(JsonLinesFormatter().format(record))
+        >>> print(entry['message'])
+        ValueError: bad value
+        >>> print(entry['exception'].splitlines()[0])
+        Traceback (most recent call last):
+    '''
+
+    _TRACEBACK_HEADER = 'Traceback (most recent call last):'
+
+    _TEMPLATE = ('{{"timestamp":"{},{:03d}","pid":{},"thread":{},"module":{},'
+                 '"level":{},"message":{},"exception":{}}}')
+
+    @staticmethod
+    def _encode(value):
+        ''' Encode a string or None as json. '''
+
+        if value is None:
+            return 'null'
+        else:
+            return json.encoder.encode_basestring(value)
+
+    def __init__(self):
+        super(JsonLinesFormatter, self).__init__()
+        # (second, formatted second), so strftime() runs at most once a second
+        self._last_time = (None, None)
+
+    def format(self, record):
+        ''' Return the record as a JSON string. '''
+
+        text = record.getMessage()
+
+        module = record.name
+        if text.startswith('- '):
+            # master log entry: "- FILENAME - LEVEL MESSAGE"
+            filename, separator, rest = text[2:].partition(' - ')
+            if separator:
+                module = filename[:-4] if filename.endswith('.log') else filename
+                text = rest
+
+        level, separator, rest = text.partition(' ')
+        if separator and level in _LEVELS:
+            text = rest
+        else:
+            level = None
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        exception = record.exc_text or None
+
+        if exception is None and text.startswith(JsonLinesFormatter._TRACEBACK_HEADER):
+            # a traceback logged as the message
+            exception = text.rstrip()
+            text = exception.rpartition('\n')[2]
+
+        second = int(record.created)
+        last_second, last_text = self._last_time
+        if second == last_second:
+            time_text = last_text
+        else:
+            time_text = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            self._last_time = (second, time_text)
+
+        encode = JsonLinesFormatter._encode
+        return JsonLinesFormatter._TEMPLATE.format(
+            time_text, int(record.msecs), record.process or 0,
+            encode(record.threadName), encode(module),
+            encode(level), encode(text), encode(exception))
+
+_json_lines_formatter = JsonLinesFormatter()
+
 class StreamHandlerFixed(logging.StreamHandler):
     ''' Fix for useless logging during some errors:
 
@@ -243,6 +394,206 @@ class StreamHandlerFixed(logging.StreamHandler):
     def handleError(self, record):
         raise
 
+class _AsyncWriter(object):
+    ''' Background writer for logs.
+
+        Opt in with start_async(). Unlike the earlier queued writer described
+        above, the queue is bounded, so memory use is bounded too. When the
+        queue is full, overflow='block' waits for room and overflow='drop'
+        discards the entry and counts it in self.dropped.
+
+        The writer thread writes entries in batches. Each log in a batch is
+        locked, written, and flushed once, instead of once per entry.
+    '''
+
+    OVERFLOW_POLICIES = ('block', 'drop')
+
+    def __init__(self, queue_size=10000, batch_size=100, overflow='block'):
+        if overflow not in _AsyncWriter.OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of {}, not {}'.format(
+                _AsyncWriter.OVERFLOW_POLICIES, overflow))
+
+        self.queue = Queue(queue_size)
+        self.batch_size = batch_size
+        self.block = overflow == 'block'
+        self.dropped = 0
+
+        self.thread = Thread(target=self.run, name='syr.log writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, log, message):
+        ''' Queue a message for log. The entry is timestamped now, not when written. '''
+
+        entry = (log, message, time.time())
+        if self.block:
+            self.queue.put(entry)
+        else:
+            try:
+                self.queue.put_nowait(entry)
+            except Full:
+                self.dropped += 1
+
+    def run(self):
+        ''' Write queued entries until stop() queues None. '''
+
+        running = True
+        while running:
+            entries = [self.queue.get()]
+            try:
+                while len(entries) < self.batch_size:
+                    entries.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            batches = {}
+            for entry in entries:
+                if entry is None:
+                    running = False
+                else:
+                    log, message, created = entry
+                    if log not in batches:
+                        batches[log] = []
+                    batches[log].append((message, created))
+
+            for log, batch in batches.items():
+                try:
+                    log._write_batch(batch)
+                except:
+                    _debug(format_exc(), force=True)
+
+            for entry in entries:
+                self.queue.task_done()
+
+    def flush(self):
+        ''' Wait until every queued entry is written. '''
+
+        self.queue.join()
+
+    def stop(self):
+        ''' Write all queued entries and stop the writer thread. '''
+
+        # always block for the stop marker, whatever the overflow policy
+        self.queue.put(None)
+        self.thread.join()
+
+class _MasterBatcher(object):
+    ''' Collects master log entries from all logs and writes them to each
+        user's master log once per interval.
+
+        Opt in with start_master_batching(). Module logs only append to an
+        in memory list, and each master log gets one locked, buffered write
+        per interval instead of one write per entry.
+    '''
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # lists of (message, created) by user
+        self.entries = {}
+        self.stopped = threading.Event()
+
+        self.thread = Thread(target=self.run, name='syr.log master batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, user, message):
+        ''' Queue a master log message for user. '''
+
+        entry = (message, time.time())
+        with self.lock:
+            try:
+                self.entries[user].append(entry)
+            except KeyError:
+                self.entries[user] = [entry]
+
+    def run(self):
+        ''' Flush every interval until stopped. '''
+
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        ''' Write all collected entries. '''
+
+        with self.lock:
+            entries = self.entries
+            self.entries = {}
+
+        for user, batch in entries.items():
+            try:
+                _master_logs[user]._write_batch(batch)
+            except:
+                _debug(format_exc(), force=True)
+
+    def stop(self):
+        ''' Stop the flush thread and write any remaining entries. '''
+
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+class _Compressor(object):
+    ''' Gzips rotated logs in a background thread, so writers never wait
+        for compression. Then removes all but the newest rotated logs.
+    '''
+
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = Thread(target=self.run, name='syr.log compressor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, rotated_path, pathname, keep):
+        ''' Compress rotated_path, then keep only 'keep' rotated logs for pathname. '''
+
+        self.queue.put((rotated_path, pathname, keep))
+
+    def run(self):
+        ''' Compress queued logs. '''
+
+        while True:
+            rotated_path, pathname, keep = self.queue.get()
+            try:
+                self.compress(rotated_path)
+                self.prune(pathname, keep)
+            except:
+                _debug(format_exc(), force=True)
+            finally:
+                self.queue.task_done()
+
+    def compress(self, path):
+        ''' Gzip path to path.gz and remove path. '''
+
+        # write to a temp name so a partial .gz is never mistaken for a rotated log
+        compressed_path = path + '.gz'
+        temp_path = compressed_path + '.tmp'
+        with io.open(path, 'rb') as infile:
+            with gzip.open(temp_path, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile)
+        os.chmod(temp_path, _DEFAULT_PERMS)
+        os.rename(temp_path, compressed_path)
+        os.remove(path)
+
+    def prune(self, pathname, keep):
+        ''' Remove all but the newest 'keep' rotated logs for pathname. '''
+
+        rotated = sorted(
+            path for path in glob('{}.[0-9]*'.format(pathname))
+            if not path.endswith('.tmp'))
+        if keep is not None and len(rotated) > keep:
+            for path in rotated[:len(rotated) - keep]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # another process removed it
+                    pass
+
+    def flush(self):
+        ''' Wait until every queued log is compressed. '''
+
+        self.queue.join()
+
 class _Log(object):
     ''' Log file.
 
@@ -257,9 +608,22 @@ class _Log(object):
         >>> log('log message 2')
 
         Logs all messages at python's DEBUG level.
-    '''
 
-    lock = threading.Lock()
+        Each log has its own lock. Logs are cached by pathname, so a slow
+        write to one log file does not block writes to another.
+
+        A log can rotate when it reaches max_bytes, or every 'interval'
+        seconds. See open().
+
+        Messages below the log's level are ignored. A disabled debug()
+        call returns after checking one attribute, before any formatting.
+
+        >>> log.set_level('INFO')
+        >>> log.is_enabled_for('DEBUG')
+        False
+        >>> log.debug('ignored %s', 'message')
+        >>> log.set_level(DEFAULT_LEVEL)
+    '''
 
     log_dir = None
     filename = None
@@ -267,7 +631,8 @@ class _Log(object):
 
     def __init__(self,
         filename=None, dirname=None, group=None,
-        recreate=False, verbose=False, audible=False):
+        recreate=False, verbose=False, audible=False,
+        max_bytes=None, interval=None, keep=None, structured=None):
         ''' 'filename' is an explicit filename.
             'dirname' is the dir to use with the default log file basename.
             'group' is the group that wns the lof file. Defaults to the group
@@ -277,6 +642,10 @@ class _Log(object):
             be overridden for a log entry.
             If audible=True, the command line 'say' program will be called
             with the message.
+            'max_bytes', 'interval', and 'keep' control rotation. They
+            default to ROTATE_MAX_BYTES, ROTATE_INTERVAL, and ROTATE_KEEP.
+            If 'structured' is True, the log is written as JSON lines.
+            The default is STRUCTURED_LOGS.
        '''
 
         self.filename = filename
@@ -286,7 +655,19 @@ class _Log(object):
         self.recreate = recreate
         self.verbose = verbose
         self.audible = audible
-
+        self.max_bytes = ROTATE_MAX_BYTES if max_bytes is None else max_bytes
+        self.interval = ROTATE_INTERVAL if interval is None else interval
+        self.keep = ROTATE_KEEP if keep is None else keep
+        self.structured = STRUCTURED_LOGS if structured is None else structured
+        # when to rotate if rotating by time, and the inode of the log file
+        # we expect to rotate, so we can tell if another process rotated it
+        self.rotate_at = None
+        self.rotation_inode = None
+
+        self.lock = threading.Lock()
+        self.set_level(DEFAULT_LEVEL)
+        # set when opened
+        self.master_prefix = None
         self.handler = None
         self.opened = False
         self.debugging = False
@@ -362,17 +743,27 @@ class _Log(object):
             if is_string(message):
                 self._write(message)
             elif isinstance(message, bytes) or isinstance(message, bytearray):
-                self._write(message.decode(errors='replace'))
+                message = message.decode(errors='replace')
+                self._write(message)
             else:
                 self.write('unable to write message because it is a {}'.format(type(message)))
 
             if self.verbose:
                 print(message)
+            # self._write() has released this log's lock, so writing the
+            # master log never holds up other writers to this log
             if _use_master_log and not self.is_master():
+                prefix = self.master_prefix or '- {} - '.format(self.filename)
                 try:
-                    _master_logs[self.user]._write('- %s - %s' % (self.filename, message))
+                    master_message = '{}{}'.format(prefix, message)
                 except UnicodeDecodeError:
-                    _master_logs[self.user]._write('- %s - !! Unable to log message -- UnicodeDecodeError !!' % (self.filename))
+                    master_message = prefix + '!! Unable to log message -- UnicodeDecodeError !!'
+
+                batcher = _master_batcher
+                if batcher is None:
+                    _master_logs[self.user]._write(master_message)
+                else:
+                    batcher.add(self.user, master_message)
 
         except UnicodeDecodeError:
             try:
@@ -396,11 +787,22 @@ class _Log(object):
                 notify_webmaster(message)
 
     def _write(self, message):
-        ''' Write directly to python logger. '''
+        ''' Write directly to python logger.
+
+            If start_async() was called, queue the message for the
+            writer thread instead. The first write to a log is always
+            direct, so the log and its master log are open before any
+            queued writes.
+        '''
 
         from syr.lock import locked
 
-        with locked(_Log.lock):
+        writer = _async_writer
+        if writer is not None and self.opened:
+            writer.put(self, message)
+            return
+
+        with locked(self.lock):
 
             self.check_user()
 
@@ -410,11 +812,64 @@ class _Log(object):
                 except:
                     self.last_exception()
 
+            self.check_rotation()
+
             try:
                 self.logger_debug(str(message))
             except:
                 self.last_exception()
 
+    def _write_batch(self, entries):
+        ''' Write a list of (message, created) entries with one lock
+            and one flush. Called by the async writer and master batcher threads. '''
+
+        from syr.lock import locked
+
+        with locked(self.lock):
+
+            self.check_user()
+
+            if not self.opened:
+                try:
+                    self.open()
+                except:
+                    self.last_exception()
+
+            self.check_rotation()
+
+            handler = self.handler
+            if handler is not None:
+                # CustomFileHandler.flush() reopens the file, so only flush once per batch
+                handler._flushing = True
+            try:
+                for message, created in entries:
+                    try:
+                        self.logger_debug(str(message), created=created)
+                    except:
+                        self.last_exception()
+            finally:
+                if handler is not None:
+                    handler._flushing = False
+                    handler.flush()
+
+    def set_level(self, level):
+        ''' Set the minimum level to log, e.g. 'INFO' or logging.INFO. '''
+
+        if level in _LEVELS:
+            level = _LEVELS[level]
+        self.level = level
+        # checked first by debug(), so disabled debug calls are cheap
+        self.debug_enabled = level <= logging.DEBUG
+
+    def is_enabled_for(self, level):
+        ''' Return whether messages at level, e.g. 'DEBUG' or logging.DEBUG, are logged. '''
+
+        return _LEVELS.get(level, level) >= self.level
+
+    # compatibility with standard python logging
+    isEnabledFor = is_enabled_for
+    setLevel = set_level
+
     def info(self, msg, *args, **kwargs):
         ''' Compatibility with standard python logging. '''
 
@@ -428,6 +883,9 @@ class _Log(object):
             want Exception details, also call log.debug().
         '''
 
+        if not self.debug_enabled:
+            return
+
         if isinstance(msg, UnicodeError):
             
             # don't log the bad data; it screws up some editors
@@ -486,12 +944,20 @@ class _Log(object):
 
             Utility function to support log.debug(), etc.
             Called as self.log('DEBUG', ...), self.log('INFO', ...), etc.
+
+            Messages below this log's level are ignored. Any args are
+            only formatted if the message is logged. As in python logging,
+            msg is formatted as "msg % args". If that fails, msg is
+            formatted as "msg.format(*args)".
         '''
 
+        if _LEVELS.get(level, self.level) < self.level:
+            return
+
         if len(kwargs.keys()):
             args = args + (kwargs,)
         if len(args):
-            message = msg.format(*args)
+            message = _format_args(msg, args)
         else:
             message = msg
 
@@ -520,14 +986,25 @@ class _Log(object):
         except Exception:
             self.last_exception()
 
-    def logger_debug(self, message):
+    def logger_debug(self, message, created=None):
+        ''' Write message to the python logger.
+
+            'created' is the time.time() the message was logged, if earlier than now.
+        '''
         try:
             try:
                 message.encode('utf-8', errors='replace')
             except UnicodeDecodeError:
                 message = '-- message contains unprintable characters --'
 
-            self.logger.debug(message)
+            if created is None:
+                self.logger.debug(message)
+            elif self.logger.isEnabledFor(logging.DEBUG):
+                record = self.logger.makeRecord(
+                    self.logger.name, logging.DEBUG, '(async)', 0, message, None, None)
+                record.created = created
+                record.msecs = (created - int(created)) * 1000
+                self.logger.handle(record)
 
         except:
             _debug(message, force=True)
@@ -553,6 +1030,7 @@ class _Log(object):
 
             if self.user not in _master_logs:
                 _master_logs[self.user] = get_log('master.log', dirname=self.dirname)
+            self.master_prefix = '- {} - '.format(self.filename)
 
             try:
                 self.handler = CustomFileHandler(self.pathname, encoding = 'UTF-8')
@@ -564,7 +1042,10 @@ class _Log(object):
                     format(self.pathname, why), force=True)
                 raise
             else:
-                formatter = logging.Formatter("%(asctime)s %(message)s")
+                if self.structured:
+                    formatter = _json_lines_formatter
+                else:
+                    formatter = logging.Formatter("%(asctime)s %(message)s")
                 self.handler.setFormatter(formatter)
                 self.handler.setLevel(logging.DEBUG)
 
@@ -579,6 +1060,16 @@ class _Log(object):
             except:
                 self.last_exception()
 
+            if self.max_bytes or self.interval:
+                try:
+                    statinfo = os.stat(self.pathname)
+                except OSError:
+                    pass
+                else:
+                    self.rotation_inode = statinfo.st_ino
+                    if self.interval:
+                        self.rotate_at = statinfo.st_mtime + self.interval
+
             # try to match the file group to the owner
             """
             try:
@@ -591,7 +1082,18 @@ class _Log(object):
             self.opened = True
 
     def flush(self):
-        ''' Flush the current buffer by closing and opening the log. '''
+        ''' Flush the current buffer by closing and opening the log.
+
+            If start_async() was called, first wait for queued entries.
+        '''
+
+        batcher = _master_batcher
+        if batcher is not None and self.is_master():
+            batcher.flush()
+
+        writer = _async_writer
+        if writer is not None and threading.current_thread() is not writer.thread:
+            writer.flush()
 
         if self.opened and self.handler is not None:
             self.handler.flush()
@@ -600,9 +1102,106 @@ class _Log(object):
         ''' Close the log. '''
 
         if self.opened and self.handler is not None:
+            # a closed FileHandler reopens its file on the next emit,
+            # so detach it from the shared python logger
+            self.logger.removeHandler(self.handler)
             self.handler.close()
             self.opened = False
 
+    def check_rotation(self):
+        ''' Rotate the log if it is too big or too old.
+
+            Call with self.lock held.
+        '''
+
+        if self.opened and (self.max_bytes or self.interval):
+            try:
+                statinfo = os.stat(self.pathname)
+            except OSError:
+                pass
+            else:
+                if statinfo.st_ino != self.rotation_inode:
+                    # another process rotated the log
+                    self.rotation_inode = statinfo.st_ino
+                    if self.interval:
+                        self.rotate_at = time.time() + self.interval
+
+                elif self.rotation_due(statinfo):
+                    self.rotate()
+
+    def rotation_due(self, statinfo):
+        ''' Return whether a log with os.stat() 'statinfo' should be rotated. '''
+
+        return bool(
+            (self.max_bytes and statinfo.st_size >= self.max_bytes) or
+            (self.interval and time.time() >= self.rotate_at and statinfo.st_size))
+
+    def rotate(self):
+        ''' Rotate the log.
+
+            The current log file is renamed with a timestamp suffix and a
+            new empty log file takes its place. The renamed log is gzipped
+            in a background thread. The old log is only renamed while
+            holding an fcntl lock, so processes sharing a log file rotate
+            it once.
+
+            Call with self.lock held.
+        '''
+
+        global _compressor
+
+        rotated_path = None
+        with io.open(self.pathname + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                # now that we have the lock, check that another process
+                # didn't rotate the log first
+                try:
+                    statinfo = os.stat(self.pathname)
+                except OSError:
+                    statinfo = None
+                if (statinfo is not None and
+                    statinfo.st_ino == self.rotation_inode and
+                    self.rotation_due(statinfo)):
+
+                    now = time.time()
+                    rotated_path = '{}.{}.{:06d}.{}'.format(
+                        self.pathname,
+                        time.strftime('%Y%m%d%H%M%S', time.gmtime(now)),
+                        int((now - int(now)) * 1000000),
+                        os.getpid())
+                    os.rename(self.pathname, rotated_path)
+
+                fd = os.open(self.pathname, os.O_CREAT | os.O_APPEND | os.O_WRONLY, _DEFAULT_PERMS)
+                try:
+                    self.rotation_inode = os.fstat(fd).st_ino
+                finally:
+                    os.close(fd)
+
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+        try:
+            os.chmod(self.pathname, _DEFAULT_PERMS)
+        except OSError:
+            # another user's process created the new log
+            pass
+
+        if self.interval:
+            self.rotate_at = time.time() + self.interval
+
+        # the handler reopens the file by name on its next write
+        if self.handler is not None:
+            self.handler.flush()
+
+        if rotated_path is not None:
+            if _compressor is None:
+                from syr.lock import locked
+                with locked(_get_log_lock):
+                    if _compressor is None:
+                        _compressor = _Compressor()
+            _compressor.add(rotated_path, self.pathname, self.keep)
+
     def is_master(self):
         ''' Return whether this log is a master log. '''
 
@@ -650,12 +1249,299 @@ class _Log(object):
             # the next write() should open the log as the right user
             self.close()
 
-def get_log(filename=None, dirname=None, group=None, recreate=False, verbose=False):    
+@contextmanager
+def _benchmark_logs(count):
+    ''' Open 'count' logs in a temporary dir for a benchmark, and yield a list of them.
+
+        The logs are opened before the benchmark times anything. On exit
+        they are closed, forgotten, and removed.
+    '''
+
+    from syr.lock import locked
+
+    user = syr._log.whoami()
+    if user not in _master_logs:
+        # keep the master log in the usual dir, not the temporary one
+        _master_logs[user] = open('master.log')
+
+    dirname = tempfile.mkdtemp(prefix='syr.log.benchmark.')
+    test_logs = []
+    try:
+        for i in range(count):
+            test_logs.append(open('benchmark{}.log'.format(i), dirname=dirname))
+        # open outside the timed section
+        for log in test_logs:
+            log('start')
+
+        yield test_logs
+
+    finally:
+        with locked(_get_log_lock):
+            for log in test_logs:
+                log.close()
+                for pathname in [path for path, value in logs.items() if value is log]:
+                    del logs[pathname]
+        shutil.rmtree(dirname, ignore_errors=True)
+
+def benchmark_contention(threads=8, log_files=4, messages=1000, shared_lock=False):
+    ''' Measure log throughput when many threads write to several logs.
+
+        Each of 'threads' threads writes 'messages' messages, round robin
+        across 'log_files' logs in a temporary dir. If shared_lock=True, all
+        the logs use one lock, like the old class wide _Log.lock, for comparison.
+
+        Returns a dict with 'seconds' and 'messages_per_second'.
+
+        >>> result = benchmark_contention(threads=2, log_files=2, messages=10)
+        >>> result['messages']
+        20
+    '''
+
+    with _benchmark_logs(log_files) as test_logs:
+        if shared_lock:
+            lock = threading.Lock()
+            for log in test_logs:
+                log.lock = lock
+
+        def writer(index):
+            for i in range(messages):
+                test_logs[(index + i) % log_files]('thread {} message {}'.format(index, i))
+
+        workers = [Thread(target=writer, args=(index,)) for index in range(threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.time() - start
+
+    total = threads * messages
+    return {
+        'threads': threads,
+        'log_files': log_files,
+        'messages': total,
+        'seconds': seconds,
+        'messages_per_second': total / seconds if seconds else None,
+        }
+
+def benchmark_master_log(messages=1000, log_files=4, interval=0.1):
+    ''' Compare log throughput with and without master log batching.
+
+        Writes 'messages' messages round robin across 'log_files' logs in a
+        temporary dir, first with a separate master log write per message,
+        then with start_master_batching(interval). Any batching already
+        running is stopped first.
+
+        Returns a dict with 'unbatched' and 'batched' messages per second.
+
+        >>> result = benchmark_master_log(messages=10, log_files=2)
+        >>> sorted(result.keys())
+        ['batched', 'unbatched']
+    '''
+
+    stop_master_batching()
+
+    result = {}
+    with _benchmark_logs(log_files) as test_logs:
+        for mode in ('unbatched', 'batched'):
+            if mode == 'batched':
+                start_master_batching(interval)
+            start = time.time()
+            for i in range(messages):
+                test_logs[i % log_files]('{} message {}'.format(mode, i))
+            # include writing everything to the master log
+            stop_master_batching()
+            seconds = time.time() - start
+            result[mode] = messages / seconds if seconds else None
+
+    return result
+
+def start_master_batching(interval=1.0):
+    ''' Write master log entries in one batch per interval.
+
+        Without batching each log entry also gets its own write to the
+        user's master log. With batching, entries from all logs are
+        collected and written to the master log every 'interval' seconds.
+        Entries keep the time they were logged.
+
+        Returns the batcher. If batching is already running, returns it unchanged.
+
+        >>> import io
+        >>> import syr.log
+        >>> batcher = syr.log.start_master_batching(interval=60)
+        >>> log = syr.log.open('/tmp/testlog-batched.log')
+        >>> log('batched master message')
+        >>> syr.log.stop_master_batching()
+        >>> with io.open(_master_logs[syr._log.whoami()].pathname) as logfile:
+        ...     '- testlog-batched.log - DEBUG batched master message' in logfile.read()
+        True
+    '''
+
+    global _master_batcher
+
+    from syr.lock import locked
+    with locked(_get_log_lock):
+        if _master_batcher is None:
+            _master_batcher = _MasterBatcher(interval=interval)
+    return _master_batcher
+
+def stop_master_batching():
+    ''' Write all batched master log entries and go back to writing them directly. '''
+
+    global _master_batcher
+
+    from syr.lock import locked
+    with locked(_get_log_lock):
+        batcher = _master_batcher
+        _master_batcher = None
+    if batcher is not None:
+        batcher.stop()
+
+# write any batched master log entries before python logging closes its handlers
+atexit.register(stop_master_batching)
+
+def start_async(queue_size=10000, batch_size=100, overflow='block'):
+    ''' Write logs from a background thread.
+
+        Log calls only queue the message, so callers don't wait for
+        log file I/O. Entries keep the time they were logged.
+
+        'queue_size' is the maximum number of queued entries.
+        'batch_size' is the maximum number of entries written at once.
+        'overflow' is what to do when the queue is full: 'block' waits
+        for room, 'drop' discards the entry.
+
+        Queued entries are written when the program exits, or when
+        stop_async() or a log's flush() is called.
+
+        Returns the writer. If the writer is already running, returns it unchanged.
+
+        >>> import io
+        >>> import syr.log
+        >>> writer = syr.log.start_async()
+        >>> log = syr.log.open('/tmp/testlog-async.log', recreate=True)
+        >>> log('first message')
+        >>> log('queued message')
+        >>> syr.log.stop_async()
+        >>> with io.open('/tmp/testlog-async.log') as logfile:
+        ...     'queued message' in logfile.read()
+        True
+    '''
+
+    global _async_writer
+
+    from syr.lock import locked
+    with locked(_get_log_lock):
+        if _async_writer is None:
+            _async_writer = _AsyncWriter(
+                queue_size=queue_size, batch_size=batch_size, overflow=overflow)
+    return _async_writer
+
+def stop_async():
+    ''' Write all queued log entries and go back to writing directly. '''
+
+    global _async_writer
+
+    from syr.lock import locked
+    with locked(_get_log_lock):
+        writer = _async_writer
+        _async_writer = None
+    if writer is not None:
+        writer.stop()
+
+# write any queued entries before python logging closes its handlers
+atexit.register(stop_async)
+
+def _format_args(msg, args):
+    ''' Format log message args, python logging style if possible.
+
+        >>> print(_format_args('%s and %d', ('text', 3)))
+        text and 3
+        >>> print(_format_args('{} and {}', ('text', 3)))
+        text and 3
+        >>> print(_format_args('%(name)s', ({'name': 'text'},)))
+        text
+        >>> print(_format_args('data: {}', ({'a': 1},)))
+        data: {'a': 1}
+        >>> print(_format_args('data: %s', ({'a': 1},)))
+        data: {'a': 1}
+    '''
+
+    if '%' in msg:
+        if len(args) == 1 and isinstance(args[0], dict) and args[0] and '%(' in msg:
+            # like python logging, a single dict is a mapping for %(name)s
+            mapping_args = args[0]
+        else:
+            mapping_args = args
+
+        try:
+            return msg % mapping_args
+        except (TypeError, ValueError, KeyError):
+            pass
+
+    return msg.format(*args)
+
+def benchmark_level_gating(disabled_calls=100000, enabled_calls=1000):
+    ''' Time log.debug() calls when debug is disabled and when it is enabled.
+
+        Returns a dict with seconds per call for 'disabled' and 'enabled'.
+
+        >>> result = benchmark_level_gating(disabled_calls=100, enabled_calls=10)
+        >>> result['disabled'] < result['enabled']
+        True
+    '''
+
+    result = {}
+    with _benchmark_logs(1) as test_logs:
+        log = test_logs[0]
+        expensive = list(range(100))
+
+        log.set_level('INFO')
+        start = time.time()
+        for i in range(disabled_calls):
+            log.debug('disabled message %s %r', i, expensive)
+        result['disabled'] = (time.time() - start) / disabled_calls
+
+        log.set_level('DEBUG')
+        start = time.time()
+        for i in range(enabled_calls):
+            log.debug('enabled message %s %r', i, expensive)
+        result['enabled'] = (time.time() - start) / enabled_calls
+
+    return result
+
+def benchmark_formatters(records=10000):
+    ''' Compare the time to format records as text and as JSON lines.
+
+        Returns a dict with seconds per record for 'text' and 'json_lines'.
+
+        >>> sorted(benchmark_formatters(records=10).keys())
+        ['json_lines', 'text']
+    '''
+
+    record = logging.LogRecord(
+        'syr.benchmark', logging.DEBUG, '', 0, 'DEBUG benchmark message', None, None)
+    result = {}
+    for name, formatter in (
+        ('text', logging.Formatter("%(asctime)s %(message)s")),
+        ('json_lines', _json_lines_formatter)):
+
+        start = time.time()
+        for i in range(records):
+            formatter.format(record)
+        result[name] = (time.time() - start) / records
+
+    return result
+
+def get_log(filename=None, dirname=None, group=None, recreate=False, verbose=False,
+    max_bytes=None, interval=None, keep=None, structured=None):
     ''' get_log() is the deprecated name for open(). '''
     
-    return open(filename=filename, dirname=dirname, group=group, recreate=recreate, verbose=verbose)
+    return open(filename=filename, dirname=dirname, group=group, recreate=recreate, verbose=verbose,
+        max_bytes=max_bytes, interval=interval, keep=keep, structured=structured)
 
-def open(filename=None, dirname=None, group=None, recreate=False, verbose=False):
+def open(filename=None, dirname=None, group=None, recreate=False, verbose=False,
+    max_bytes=None, interval=None, keep=None, structured=None):
     ''' Open log. Default is a log for the calling module.
     
         The default log path is "BASE_LOG_DIR/USER/MODULE.log".
@@ -668,6 +1554,18 @@ def open(filename=None, dirname=None, group=None, recreate=False, verbose=False)
         If recreate=True and the log file is not already open, any existing 
         log file is removed.
 
+        The log rotates when it reaches 'max_bytes' bytes, or every
+        'interval' seconds. Rotated logs are named "LOGPATH.TIMESTAMP.PID"
+        and gzipped in the background. Only the newest 'keep' rotated logs
+        are kept. Defaults are ROTATE_MAX_BYTES, ROTATE_INTERVAL, and
+        ROTATE_KEEP. Rotation is safe when several processes write the
+        same log.
+
+        If structured=True, the log is written as JSON lines. See
+        JsonLinesFormatter. The default is STRUCTURED_LOGS.
+
+        Like the other options, these only apply when the log is first opened.
+
         >>> import os.path
         >>> import syr.log
 
@@ -685,6 +1583,22 @@ def open(filename=None, dirname=None, group=None, recreate=False, verbose=False)
         >>> log('log message')
         >>> print(log.dirname)
         /tmp
+
+        >>> from glob import glob
+        >>> log = syr.log.open('testlog-rotate.log', dirname='/tmp/logs', max_bytes=200, keep=2)
+        >>> for i in range(20):
+        ...     log('log message {}'.format(i))
+        >>> syr.log._compressor.flush()
+        >>> len(glob('/tmp/logs/testlog-rotate.log.*.gz'))
+        2
+
+        >>> import io, json
+        >>> log = syr.log.open('/tmp/testlog-structured.log', recreate=True, structured=True)
+        >>> log.info('structured message')
+        >>> with io.open('/tmp/testlog-structured.log') as logfile:
+        ...     entry = json.loads(logfile.readline())
+        >>> print(entry['level'], entry['message'])
+        INFO structured message
     '''
 
     from syr.lock import locked
@@ -698,7 +1612,9 @@ def open(filename=None, dirname=None, group=None, recreate=False, verbose=False)
         else:
             log = _Log(
                 filename=filename, dirname=dirname,
-                group=group, recreate=recreate, verbose=verbose)
+                group=group, recreate=recreate, verbose=verbose,
+                max_bytes=max_bytes, interval=interval, keep=keep,
+                structured=structured)
             logs[logpath] = log
 
     return log
@@ -711,6 +1627,9 @@ def get_log_path(filename=None, dirname=None):
         If filename is specified and starts with a '/', it is the log path.
         If filename is specified and does not start with a '/', it replaces "MODULE.log".
 
+        Paths are cached, so repeated calls from the same caller file don't
+        walk the stack or touch the filesystem.
+
         >>> import os.path
         >>> from syr.log import get_log
 
@@ -725,8 +1644,25 @@ def get_log_path(filename=None, dirname=None):
         >>> path = get_log_path('testlog3.log')
         >>> assert os.path.basename(path) == 'testlog3.log'
         >>> assert os.path.dirname(path) == os.path.join(BASE_LOG_DIR, syr._log.whoami())
+
+        >>> paths = [get_log_path() for i in range(2)]
+        >>> assert paths[0] == paths[1]
     '''
 
+    if filename is None:
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_filename == _this_file:
+            frame = frame.f_back
+        caller = frame.f_code.co_filename if frame is not None else None
+        key = (None, caller, dirname, BASE_LOG_DIR, os.geteuid())
+    else:
+        key = (filename, None, dirname, BASE_LOG_DIR, os.geteuid())
+
+    try:
+        return _log_paths[key]
+    except KeyError:
+        pass
+
     if filename is None:
         from syr.python import caller_module_name
         filename = caller_module_name(ignore=[__file__])
@@ -743,6 +1679,7 @@ def get_log_path(filename=None, dirname=None):
         assert dirname.startswith('/')
 
     logpath = os.path.join(dirname, filename)
+    _log_paths[key] = logpath
 
     return logpath
 
@@ -753,10 +1690,11 @@ def default_log_dir():
        The default is /var/local/log/USER. This avoids log ownership conflicts.
     '''
 
-    create_base_log_dir()
     user = syr._log.whoami()
     dirname = os.path.join(BASE_LOG_DIR, user)
-    makedir(dirname)
+    if dirname not in _log_dirs:
+        create_base_log_dir()
+        makedir(dirname)
     return dirname
 
 def delete_all_logs(dirname=None):
@@ -778,6 +1716,8 @@ def delete_all_logs(dirname=None):
                 shutil.rmtree(entry)
             else:
                 os.remove(entry)
+        # some cached dirs may be gone
+        _log_dirs.clear()
 
 def default_log_filename(name):
     ''' Make sure log filenames look like logs. '''
@@ -811,6 +1751,11 @@ def create_base_log_dir():
         os.chmod(BASE_LOG_DIR, BASE_LOG_DIR_PERMS)
 
 def makedir(dirname, perms=_DEFAULT_LOG_DIR_PERMS):
+    ''' Make sure dirname exists. Dirs that we know exist are cached. '''
+
+    if dirname in _log_dirs:
+        return
+
     if not os.path.exists(dirname):
         try:
             os.makedirs(dirname, perms)
@@ -821,6 +1766,7 @@ def makedir(dirname, perms=_DEFAULT_LOG_DIR_PERMS):
             _debug(why, force=True)
             raise
     assert os.path.isdir(dirname)
+    _log_dirs.add(dirname)
 
 if __name__ == "__main__":
 
@@ -1,8 +1,8 @@
 '''
-    Map function using Parallel Python.
+    Map function using a pool of processes.
 
     Copyright 2010-2016 GoodCrypto
-    Last modified: 2016-04-20
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
@@ -11,52 +11,57 @@ from __future__ import unicode_literals
 import sys
 IS_PY2 = sys.version_info[0] == 2
 
-if IS_PY2:
-    import __builtin__
-else:
-    import builtins
+import atexit, importlib, multiprocessing, threading
+from itertools import chain, islice
 
 class MapPP():
     ''' Parallel map().
 
-        Mappp speeds up parallel processes that are limited by
-        a resource other than the cpu. If your work is CPU
-        bound, you probably won't see any speed improvement on
-        a single processor machine.
-
-        This version is based on the Parallel Python module. PP
-        works with multiple processes on a single processor,
-        multiple processors on a single machine, or multiple
-        machines in a cluster. Because MapPP abstracts the parallel
-        implementation, it can easily use a different underlying
-        parallelization in the future.
-
-        The default number of parallel processes for a single
-        processor machine with one core is 10. For a multi-processor
-        machine it is the number of processors. For a cluster it is
-        the number of ppservers passed in the "ppservers" keyword.
-        You can set ncpus to the maximum number of local processes
-        you want. If you set it to one this class will map each
+        MapPP speeds up work that is limited by the cpu by running it
+        in several processes, so it can use every core.
+
+        MapPP was based on the Parallel Python module, which was
+        unreliable and cumbersome. It now uses a multiprocessing pool.
+        Because MapPP abstracts the parallel implementation, callers
+        did not have to change.
+
+        Pools are kept between calls to map(), one for each combination
+        of ncpus and modules, and closed when the program exits. So only
+        the first map() pays to start processes. Call MapPP.shutdown() to
+        close them sooner.
+
+        The default number of processes is the number of cpus, but at
+        least default_min_cpus. You can set ncpus to the number of
+        processes you want. If you set it to one this class will map each
         item consecutively, like python's builtin map().
 
-        The instantiation args are passed through to pp.Server and
-        pp.Server.submit(). See the pp module documentation for details.
+        If the work function needs modules imported, list their names in
+        the modules arg. Each process imports them when it starts.
+
+        Items are sent to processes in chunks of 'chunksize' items to cut
+        overhead. The default picks a chunksize that gives each process
+        about four chunks. If there are fewer than 'min_items' items, they
+        are mapped in this process, since starting work in other processes
+        costs more than it saves.
 
-        If the work function you pass to map calls any other
-        functions or requires any imported modules, list them in the
-        depfuncs and modules args. The depfuncs arg is a tuple of
-        functions. The modules arg is a tuple of strings, where each
-        string is a module name.
+        The work function, items, and results must be picklable. The work
+        function must be defined at the top level of a module.
 
-        The imported modules for pp are relative to the pp module. So
-        if you need to import pp.pp itself, move the import to within
-        the function that uses it, use 'import pp.pp', and the
-        import name passed in the modules arg is 'pp'.'''
+        The pp arguments ppservers, secret, loglevel, logstream, restart,
+        proto, depfuncs, group, and globals are accepted but ignored.
+        Processes import functions by name, so depfuncs is not needed.
+        If 'callback' is set, it is called in this process as
+        callback(result, *callbackargs) for each result.'''
 
-    default_min_cpus = 10
+    default_min_cpus = 1
+    default_min_items = 10
 
-    server_is_singleton = False
-    pp_server = None
+    # kept for compatibility. Pools are always kept between calls now.
+    server_is_singleton = True
+
+    # multiprocessing pools by (processes, modules)
+    _pools = {}
+    _pools_lock = threading.Lock()
 
     def __init__(self,
 
@@ -67,85 +72,92 @@ class MapPP():
 
         # pp.Server.submit() args
         depfuncs=(), modules=(),
-        callback=None, callbackargs=(), group='default', globals=None):
-
-        ''' Initialize a parallel map.'''
-
-        ''' The debian (version 1.57 on lenny) distribution for pp is
-            slightly different. Ubuntu is a debian derivative and behaves
-            similarly.
-        '''
-        try:
-            from pp import pp
-        except:
-            import pp
-
-        def new_server():
-            ''' Instantiate a pp server.'''
-
-            if pp.version.startswith('1.5'):
-
-                server = pp.Server(
-                    ncpus=ncpus, ppservers=ppservers, secret=secret,
-                    loglevel=loglevel, logstream=logstream,
-                    )
-
-            else:
-
-                server = pp.Server(
-                    ncpus=ncpus, ppservers=ppservers, secret=secret,
-                    restart=restart, proto=proto
-                    )
+        callback=None, callbackargs=(), group='default', globals=None,
 
-            return server
+        # pool args
+        chunksize=None, min_items=None):
 
-        if MapPP.server_is_singleton:
-            if not MapPP.pp_server:
-                MapPP.pp_server = new_server()
-            self.pp_server = MapPP.pp_server
-        else:
-            self.pp_server = new_server()
+        ''' Initialize a parallel map.'''
 
-        if self.pp_server.get_ncpus() <= 1 and ncpus == 'autodetect':
-            self.pp_server.set_ncpus(MapPP.default_min_cpus)
+        if ncpus == 'autodetect':
+            try:
+                ncpus = multiprocessing.cpu_count()
+            except NotImplementedError:
+                ncpus = 1
+            ncpus = max(ncpus, MapPP.default_min_cpus)
 
-        self.depfuncs = depfuncs
-        self.modules = modules
+        self.ncpus = ncpus
+        self.modules = tuple(modules)
         self.callback = callback
         self.callbackargs = callbackargs
-        self.group = group
-        self.globals = globals
+        self.chunksize = chunksize
+        self.min_items = MapPP.default_min_items if min_items is None else min_items
 
     def map(self, work_function, required_iterable, *optional_iterables):
         ''' Parallel map().'''
 
-        def submit(item):
-            ''' Submit work_function(item) to pp as a separate task.'''
-
-            return self.pp_server.submit(
-                work_function, (item,),
-                depfuncs = self.depfuncs,
-                modules = self.modules,
-                callback = self.callback,
-                callbackargs = self.callbackargs,
-                group = self.group,
-                globals = self.globals)
-
-        items = []
-        items.extend(required_iterable)
-        for optional_iterable in optional_iterables:
-            items.extend(optional_iterable)
-
-        if IS_PY2:
-            tasks = __builtin__.map(submit, items)
-        else:
-            tasks = builtins.map(submit, items)
-        results = [task_result() for task_result in tasks]
+        return list(self.imap(work_function, required_iterable, *optional_iterables))
+
+    def imap(self, work_function, required_iterable, *optional_iterables):
+        ''' Parallel map() that yields results in order as they are ready. '''
+
+        items = chain(required_iterable, *optional_iterables)
+        # look ahead to see whether there is enough work to use the pool
+        first_items = list(islice(items, self.min_items))
+
+        if self.ncpus <= 1 or len(first_items) < self.min_items:
+            _import_modules(self.modules)
+            results = (work_function(item) for item in chain(first_items, items))
 
-        if not MapPP.server_is_singleton:
-            self.pp_server.destroy()
+        else:
+            chunksize = self.chunksize
+            if chunksize is None:
+                if hasattr(required_iterable, '__len__') and not optional_iterables:
+                    chunksize = max(1, len(required_iterable) // (self.ncpus * 4))
+                else:
+                    chunksize = 1
+            pool = self.pool()
+            results = pool.imap(work_function, chain(first_items, items), chunksize)
+
+        for result in results:
+            if self.callback is not None:
+                self.callback(result, *self.callbackargs)
+            yield result
+
+    def pool(self):
+        ''' Return the pool for this map's ncpus and modules. '''
+
+        key = (self.ncpus, self.modules)
+        with MapPP._pools_lock:
+            if key not in MapPP._pools:
+                MapPP._pools[key] = multiprocessing.Pool(
+                    processes=self.ncpus,
+                    initializer=_import_modules, initargs=(self.modules,))
+            return MapPP._pools[key]
+
+    @staticmethod
+    def shutdown():
+        ''' Close all pools and wait for their processes to exit. '''
+
+        with MapPP._pools_lock:
+            pools = list(MapPP._pools.values())
+            MapPP._pools.clear()
+        for pool in pools:
+            pool.close()
+            pool.join()
+
+atexit.register(MapPP.shutdown)
+
+def _import_modules(modules):
+    ''' Import modules, e.g. to warm up a worker process. '''
+
+    for module in modules:
+        importlib.import_module(module)
+
+def _test_square(x):
+    ''' Test work function.'''
 
-        return results
+    return x * x
 
 def test_read_from_web(url):
     ''' Test work function.'''
@@ -157,28 +169,23 @@ def test_read_from_web(url):
         return urllib.request.urlopen(url).getcode()
 
 def mappp(work_function, iterable, **kwargs):
-    ''' Map function using Parallel Python.
-
-        Warning: unreliable and cumbersome.
+    ''' Map function using a pool of processes.
 
-        This function is not called map() because Parallel Python
-        imposes some significant restrictions over the standard map().
+        This function is not called map() because it imposes some
+        restrictions over the standard map(). The work function, items,
+        and results must be picklable, and the work function must be
+        defined at the top level of a module.
 
-        In the  work_function, scoping is very different from the
-        builtin map(). All variables used must be local to the function.
-        All functions used must be declared using the "depfuncs" keyword.
-        All imported modules used must be declared using the "modules"
-        keyword.
-
-        All arguments to the work_function and the return value must be
-        picklable.
-
-        In order for this map function to accept pp keyword arguments, it
+        In order for this map function to accept keyword arguments, it
         only allows one iterable. This is almost always the case with map(),
         and it's easy to combine iterables anyway.
 
-        >>> mappp(test_read_from_web, ['http://google.com', 'http://bing.com'], depfuncs=['test_read_from_web'], modules=['syr.mappp', 'pp', 'urllib'],)
-        [200, 200]
+        See MapPP for the keyword arguments.
+
+        >>> mappp(_test_square, [1, 2, 3])
+        [1, 4, 9]
+        >>> sum(mappp(_test_square, range(1000), modules=['syr.mappp']))
+        332833500
     '''
 
     return MapPP(**kwargs).map(work_function, iterable)
@@ -1,8 +1,11 @@
 '''
     Threaded map().
 
+    For I/O bound work with many items, syr.apmap runs the work on an
+    asyncio event loop instead of in threads.
+
     Copyright 2010-2016 GoodCrypto
-    Last modified: 2016-04-20
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
@@ -12,19 +15,20 @@ import sys
 IS_PY2 = sys.version_info[0] == 2
 
 if IS_PY2:
-    import __builtin__
+    from Queue import Queue
 else:
-    import builtins
+    from queue import Queue
+from itertools import chain, islice
 import threading
-import time
 
 from syr.log import get_log
-from syr.lock import locked
-from syr.python import object_name
 
 log = get_log()
 
-class Pmap():
+# default number of worker threads per Pmap
+DEFAULT_MAX_WORKERS = 32
+
+class Pmap(object):
     ''' Parallel map().
 
         Pmap speeds up parallel processes that are limited by
@@ -33,80 +37,171 @@ class Pmap():
 
         There are other parallel python modules that try to work with
         multiprocessors, clusters and the cloud. They don't seem reliable.
-        Pmap works in memory on a single cpu.'''
-
-    class Task():
-        ''' Task to map one item in a separate thread. '''
-
-        def __init__(self, work_function, item):
-            self.work_function = work_function
-            self.item = item
-            self.lock = threading.Condition()
-            self.started = False
-            self.done = False
-            thread = threading.Thread(
-                target=Pmap.Task.run,
-                args=(self, work_function, item))
-            thread.start()
-
-        def run(self, work_function, item):
-            ''' Runs the work function and notifies that the result is ready. '''
-
-
-            #log('%s run() acquiring lock' % self)
-            with locked(self.lock):
-                #log('%s run() lock accquired' % self)
-                self.started = True
-                # the work_function() should yield (time.sleep(0)) when possible,
-                # or call lock.wait()/notify() as needed
-                self.task_result = work_function(item)
-                self.done = True
-                #log('%s run() notifying' % self)
-                self.lock.notify()
-                #log('%s run() releasing' % self)
-            #log('%s run() lock released' % self)
-
-        def result(self):
-            ''' Waits until the work function is done and the result is ready.
-                Returns the result. '''
-
-            ''' We have to acquire the lock first to ensure self.done is
-                in a valid state.
-
-                Otherwise apparently the acquire() in run gets the lock, and
-                then allows other threads to start before acquire() returns.
-                If result() starts during this period, then self.done is
-                False. But because we then call acquire() in result(), we
-                get a deadlock waiting to acquire the lock. We never get to
-                the wait(). '''
-            #log('%s result() acquiring lock' % self)
-            with locked(self.lock):
-                # is this 'if' atomic wrt threading?
-                if not self.done:
-                    #log('%s result() waiting' % self)
-                    self.lock.wait()
-                #log('%s result() releasing' % self)
-            #log('%s result() lock released' % self)
-
-            return self.task_result
-
-        def __unicode__(self):
-            return '%s %r' % (object_name(self), self.item)
-
-    def __init__(self, work_function, required_iterable, *optional_iterables):
-        ''' Start tasks. '''
-
-        items = []
-        items.extend(required_iterable)
-        for optional_iterable in optional_iterables:
-            items.extend(optional_iterable)
-
-        self.tasks = (Pmap.Task(work_function, item) for item in items)
+        Pmap works in memory on a single cpu.
+
+        Work runs on a pool of at most 'max_workers' threads. No threads
+        start until you iterate over results(), and there is never more
+        than one worker per chunk read. Items are read from the iterables
+        only as workers need them. At most
+        'max_pending' chunks of items are read but not yet returned by
+        results(), so a slow consumer slows down reading the input
+        instead of using more memory.
+
+        Keyword args:
+            max_workers: Number of worker threads. Default is DEFAULT_MAX_WORKERS.
+            ordered: If True, the default, results are in input order.
+                     If False, results are returned as they are completed.
+            chunksize: Number of items a worker handles at a time. Larger
+                       chunks cut overhead when each item is little work.
+                       Default is 1.
+            max_pending: Maximum chunks read but not yet returned.
+                         Default is twice max_workers.
+            return_exceptions: If False, the default, an exception raised by
+                               the work function for an item is raised by
+                               results() at that item. If True, the
+                               exception is returned as that item's result.
+    '''
 
-    def results(self):
-        ''' Get results from tasks. '''
+    def __init__(self, work_function, required_iterable, *optional_iterables, **kwargs):
+        ''' Set up the map. Threads start when results() is iterated. '''
+
+        self.work_function = work_function
+        self.max_workers = kwargs.pop('max_workers', DEFAULT_MAX_WORKERS)
+        self.ordered = kwargs.pop('ordered', True)
+        self.chunksize = kwargs.pop('chunksize', 1)
+        max_pending = kwargs.pop('max_pending', None)
+        self.return_exceptions = kwargs.pop('return_exceptions', False)
+        if kwargs:
+            raise TypeError('unexpected keyword args: {}'.format(', '.join(kwargs)))
+        if self.max_workers < 1 or self.chunksize < 1:
+            raise ValueError('max_workers and chunksize must be at least 1')
+
+        if max_pending is None:
+            max_pending = 2 * self.max_workers
+
+        self.items = chain(required_iterable, *optional_iterables)
+        self.stopped = threading.Event()
+        # one slot per chunk read but not yet returned by results()
+        self.slots = threading.Semaphore(max_pending)
+        self.chunks = Queue()
+        # (chunk index, [(ok, result or exception), ...]), or (None, exception)
+        # if reading the input failed, or ('count', number of chunks) when
+        # all chunks are read
+        self.done_chunks = Queue()
+
+        self.threads = []
+        # only changed by the feeder thread
+        self.worker_count = 0
+
+    def start(self):
+        ''' Start the feeder thread, which starts workers as needed. '''
+
+        if not self.threads:
+            self.start_thread(self.feed, 'pmap feeder')
+
+    def start_thread(self, target, name):
+        ''' Start a daemon thread. '''
+
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def feed(self):
+        ''' Read chunks of items as slots free up and queue them for workers. '''
+
+        index = 0
+        try:
+            while True:
+                # results() releases a slot for each chunk returned, and
+                # stop() releases one to wake us
+                self.slots.acquire()
+                if self.stopped.is_set():
+                    break
+
+                chunk = list(islice(self.items, self.chunksize))
+                if not chunk:
+                    self.slots.release()
+                    break
+
+                self.chunks.put((index, chunk))
+                index += 1
+                if self.worker_count < self.max_workers:
+                    self.worker_count += 1
+                    self.start_thread(self.work, 'pmap worker')
+
+        except Exception as exc:
+            self.done_chunks.put((None, exc))
+
+        finally:
+            # tell results() how many chunks there are, and stop the workers
+            self.done_chunks.put(('count', index))
+            for i in range(self.worker_count):
+                self.chunks.put(None)
+
+    def work(self):
+        ''' Run the work function on queued chunks. '''
+
+        while True:
+            task = self.chunks.get()
+            if task is None or self.stopped.is_set():
+                break
+
+            index, chunk = task
+            results = []
+            for item in chunk:
+                try:
+                    results.append((True, self.work_function(item)))
+                except Exception as exc:
+                    results.append((False, exc))
+            self.done_chunks.put((index, results))
 
-        return (task.result() for task in self.tasks)
+    def results(self):
+        ''' Get results from workers. '''
+
+        self.start()
+
+        pending = {}
+        next_index = 0
+        chunk_count = None
+        try:
+            while chunk_count is None or next_index < chunk_count:
+                index, results = self.done_chunks.get()
+
+                if index == 'count':
+                    chunk_count = results
+                    continue
+                elif index is None:
+                    # reading the input raised an exception
+                    raise results
+
+                if self.ordered:
+                    pending[index] = results
+                    ready = []
+                    while next_index in pending:
+                        ready.append(pending.pop(next_index))
+                        next_index += 1
+                else:
+                    ready = [results]
+                    next_index += 1
+
+                for results in ready:
+                    self.slots.release()
+                    for ok, result in results:
+                        if ok or self.return_exceptions:
+                            yield result
+                        else:
+                            raise result
+
+        finally:
+            self.stop()
+
+    def stop(self):
+        ''' Stop reading input and running work. Work already started finishes. '''
+
+        self.stopped.set()
+        # wake the feeder if it is waiting for a slot
+        self.slots.release()
 
 def _test_function(s):
     ''' Test work function.'''
@@ -116,11 +211,31 @@ def _test_function(s):
 def pmap(work_function, iterable, **kwargs):
     ''' Threaded map().
 
-        >>> pmap(_test_function, ['a', 'b'],)
+        Returns a generator of results. The keyword args are passed to Pmap.
+
+        >>> list(pmap(_test_function, ['a', 'b'],))
         ['ax', 'bx']
+
+        >>> list(pmap(_test_function, range(10), max_workers=2, chunksize=3))
+        ['0x', '1x', '2x', '3x', '4x', '5x', '6x', '7x', '8x', '9x']
+
+        >>> sorted(pmap(_test_function, ['a', 'b', 'c'], ordered=False))
+        ['ax', 'bx', 'cx']
+
+        >>> def fail_on_b(s):
+        ...     if s == 'b':
+        ...         raise ValueError(s)
+        ...     return s
+        >>> results = list(pmap(fail_on_b, ['a', 'b'], return_exceptions=True))
+        >>> results[0], type(results[1]).__name__
+        ('a', 'ValueError')
+        >>> list(pmap(fail_on_b, ['a', 'b']))
+        Traceback (most recent call last):
+        ...
+        ValueError: b
     '''
 
-    return Pmap(work_function, iterable).results()
+    return Pmap(work_function, iterable, **kwargs).results()
 
 
 if __name__ == "__main__":
@@ -5,7 +5,7 @@
     command line programs are more likely to have been thoroughly vetted.
 
     Copyright 2013-2016 GoodCrypto
-    Last modified: 2016-05-24
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
@@ -415,8 +415,8 @@ def call(*args, **kwargs):
 
     def _call(strip_white_space=True, ok_return_codes=None, shell=False):
 
-        log.debug('    _call(): {} (type {})'.format(args, type(args))) # DEBUG
-        log.debug('    _call(): shell={}'.format(shell)) # DEBUG
+        log.debug('    _call(): %s (type %s)', args, type(args)) # DEBUG
+        log.debug('    _call(): shell=%s', shell) # DEBUG
         try:
             result = subprocess.check_output(args,
                 stderr=subprocess.STDOUT, shell=shell)
@@ -440,8 +440,10 @@ def call(*args, **kwargs):
 
         return result
 
-    log.debug('call(): {} (type {})'.format(args, type(args)))
-    log.debug('call() whoami: {}'.format(subprocess.check_output('whoami')))
+    log.debug('call(): %s (type %s)', args, type(args))
+    if log.is_enabled_for('DEBUG'):
+        # don't run a whoami process unless the result is logged
+        log.debug('call() whoami: %s', subprocess.check_output('whoami'))
     try:
         result = _call(**kwargs)
     except OSError as ose:
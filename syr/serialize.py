@@ -11,6 +11,14 @@
     wins. Default serializers should be set in order of increasing
     preference.
 
+    Serializers don't log or time each call. To see what serialization
+    costs, call enable_metrics(). See SerializerMetrics.
+
+    The default serializer is a reasonable choice, not a measured one.
+    To compare serializers on your own data, use benchmark_serializers().
+    choose_serializer() picks the fastest serializer that decodes a
+    sample object exactly as it was.
+
     Copyright 2014-2016 GoodCrypto.
     Last modified: 2016-05-27
 
@@ -83,17 +91,127 @@ from __future__ import unicode_literals
 import sys
 IS_PY2 = sys.version_info[0] == 2
 
-import datetime, os, pickle, tempfile
+import ast, datetime, functools, math, pickle, re, struct, threading, time, zlib
 
 from syr.dict import dictify, DictObject
 from syr.format import pretty
 from syr.log import get_log
 from syr.python import last_exception
-from syr.times import elapsed_time
 from syr.utils import NotImplementedException
 
 log = get_log()
 
+# SerializerMetrics while metrics are enabled, else None
+_metrics = None
+
+class SerializerMetrics(object):
+    ''' Call counts and sampled timing for serializers.
+
+        Every encode() and decode() is counted. One call in every
+        1/sample_rate is timed, and its time is added to a histogram
+        with power of 2 buckets in microseconds. Timing every call would
+        cost more than a small encode.
+
+        >>> metrics = SerializerMetrics(sample_rate=1)
+        >>> metrics.measure('Test', 'encode', lambda obj: obj, 1)
+        1
+        >>> snapshot = metrics.snapshot()
+        >>> snapshot['Test.encode']['calls'], snapshot['Test.encode']['sampled']
+        (1, 1)
+    '''
+
+    def __init__(self, sample_rate=0.01):
+        self.sample_every = max(1, int(round(1 / sample_rate)))
+        self.lock = threading.Lock()
+        # by 'SERIALIZER.OPERATION'
+        self.calls = {}
+        self.sampled = {}
+        self.seconds = {}
+        # by 'SERIALIZER.OPERATION', dict of count by bucket, the microsecond
+        # upper bound of the bucket
+        self.histograms = {}
+
+    def measure(self, serializer_name, operation, function, *args, **kwargs):
+        ''' Count a call to function(*args, **kwargs), and maybe time it.
+
+            Returns what the function returns. '''
+
+        key = '{}.{}'.format(serializer_name, operation)
+        with self.lock:
+            calls = self.calls.get(key, 0) + 1
+            self.calls[key] = calls
+
+        if calls % self.sample_every:
+            return function(*args, **kwargs)
+
+        start = time.time()
+        result = function(*args, **kwargs)
+        seconds = time.time() - start
+
+        bucket = 2 ** max(0, math.frexp(seconds * 1000000)[1])
+        with self.lock:
+            self.sampled[key] = self.sampled.get(key, 0) + 1
+            self.seconds[key] = self.seconds.get(key, 0.0) + seconds
+            histogram = self.histograms.setdefault(key, {})
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        return result
+
+    def snapshot(self):
+        ''' Return a dict by 'SERIALIZER.OPERATION' of dicts with 'calls',
+            'sampled', 'mean_seconds' of sampled calls, and 'histogram'. '''
+
+        with self.lock:
+            snapshot = {}
+            for key, calls in self.calls.items():
+                sampled = self.sampled.get(key, 0)
+                snapshot[key] = {
+                    'calls': calls,
+                    'sampled': sampled,
+                    'mean_seconds': self.seconds[key] / sampled if sampled else None,
+                    'histogram': dict(self.histograms.get(key, {})),
+                    }
+            return snapshot
+
+def enable_metrics(sample_rate=0.01):
+    ''' Start collecting SerializerMetrics for all serializers.
+
+        Returns the metrics. '''
+
+    global _metrics
+
+    _metrics = SerializerMetrics(sample_rate)
+    return _metrics
+
+def disable_metrics():
+    ''' Stop collecting metrics. '''
+
+    global _metrics
+
+    _metrics = None
+
+def serializer_metrics():
+    ''' Return a snapshot of the current SerializerMetrics, or None if
+        metrics are not enabled. '''
+
+    metrics = _metrics
+    return None if metrics is None else metrics.snapshot()
+
+def _measured(method):
+    ''' Decorator for encode() and decode() that reports to the
+        SerializerMetrics, if enabled. '''
+
+    @functools.wraps(method)
+    def measured(self, *args, **kwargs):
+        metrics = _metrics
+        if metrics is None:
+            return method(self, *args, **kwargs)
+        else:
+            return metrics.measure(type(self).__name__, method.__name__,
+                                   method, self, *args, **kwargs)
+
+    return measured
+
 def json_date_handler(obj):
     if hasattr(obj, 'isoformat'):
         return obj.isoformat()
@@ -112,10 +230,32 @@ class _Test(object):
     def __init__(self):
         self.d = {'x': 2, 'y': 'b'}
 
+# length prefix for each object in a stream
+_FRAME_LENGTH = struct.Struct('>I')
+
 class AbstractSerializer(object):
     ''' Serializer abstract class.
 
-        Subclasses  must implement at least encode() and decode(). '''
+        Subclasses  must implement at least encode() and decode().
+
+        write_stream() and read_stream() serialize a sequence of objects
+        one at a time, so a large dataset never has to be in memory at
+        once. By default each object is written as a frame: a 4 byte
+        length, then encode(obj). Subclasses that change the stream
+        format set 'stream_mode' to 't' if the stream is text.
+
+        >>> serializer = BuiltinPickle()
+        >>> filename = '/tmp/syr.serialize.stream.test'
+        >>> serializer.tostream(filename, ({'n': n} for n in range(3)))
+        >>> for obj in serializer.fromstream(filename):
+        ...     print(obj['n'])
+        0
+        1
+        2
+    '''
+
+    # file mode for streams, 'b' for binary or 't' for text
+    stream_mode = 'b'
 
     def encode(self, obj):
         ''' Encode object to serialized form '''
@@ -158,6 +298,65 @@ class AbstractSerializer(object):
         with open(filename, 'wt') as outfile:
             self.write(outfile, obj)
 
+    def write_stream(self, openfile, objects):
+        ''' Write each object from an iterable to an open file.
+
+            Use tostream() to serialize to a named file. '''
+
+        for obj in objects:
+            data = self._encode_frame(obj)
+            openfile.write(_FRAME_LENGTH.pack(len(data)))
+            openfile.write(data)
+
+    def read_stream(self, openfile):
+        ''' Yield each object from an open file written by write_stream().
+
+            Use fromstream() to deserialize from a named file. '''
+
+        while True:
+            prefix = openfile.read(_FRAME_LENGTH.size)
+            if not prefix:
+                break
+            if len(prefix) < _FRAME_LENGTH.size:
+                raise EOFError('stream ends inside a frame length')
+
+            length, = _FRAME_LENGTH.unpack(prefix)
+            data = openfile.read(length)
+            if len(data) < length:
+                raise EOFError('stream ends inside a frame')
+
+            yield self._decode_frame(data)
+
+    def tostream(self, filename, objects):
+        ''' Write each object from an iterable to a file.
+
+            Use write_stream() to serialize to an open file. '''
+
+        with open(filename, 'w' + self.stream_mode) as outfile:
+            self.write_stream(outfile, objects)
+
+    def fromstream(self, filename):
+        ''' Yield each object from a file written by tostream().
+
+            Use read_stream() to deserialize from an open file. '''
+
+        with open(filename, 'r' + self.stream_mode) as infile:
+            for obj in self.read_stream(infile):
+                yield obj
+
+    def _encode_frame(self, obj):
+        ''' Encode an object for one frame of a stream. Returns bytes. '''
+
+        encoded = self.encode(obj)
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode('utf-8')
+        return encoded
+
+    def _decode_frame(self, data):
+        ''' Decode an object from one frame of a stream. '''
+
+        return self.decode(data)
+
 class BuiltinPickle(AbstractSerializer):
     ''' Builtin pickle serializer
 
@@ -170,23 +369,17 @@ class BuiltinPickle(AbstractSerializer):
         {'12345': datetime.datetime(1, 2, 3, 4, 5)}
     '''
 
+    @_measured
     def encode(self, obj):
         ''' Encode object to serialized form '''
 
-        with elapsed_time() as et:
-            encoded = pickle.dumps(obj)
-        log('BuiltinPickle.encode elapsed time: %s' % et.timedelta())
-        return encoded
-
+        return pickle.dumps(obj)
 
+    @_measured
     def decode(self, encoded):
         ''' Decode object from serialized form '''
 
-        log('decoding with BuiltinPickle')
-        with elapsed_time() as et:
-            decoded = pickle.loads(encoded)
-        log('BuiltinPickle decode elapsed time: %s' % et.timedelta())
-        return decoded
+        return pickle.loads(encoded)
 
 DefaultSerializer = BuiltinPickle
 
@@ -211,23 +404,17 @@ else:
             {'12345': datetime.datetime(1, 2, 3, 4, 5)}
         '''
 
+        @_measured
         def encode(self, obj):
             ''' Encode object to serialized form '''
 
-            with elapsed_time() as et:
-                encoded = jsonpickle.encode(obj)
-            log('JsonPickle.encode elapsed time: %s' % et.timedelta())
-            return encoded
-
+            return jsonpickle.encode(obj)
 
+        @_measured
         def decode(self, encoded):
             ''' Decode object from serialized form '''
 
-            log('decoding with JsonPickle')
-            with elapsed_time() as et:
-                decoded = jsonpickle.decode(encoded)
-            log('JsonPickle decode elapsed time: %s' % et.timedelta())
-            return decoded
+            return jsonpickle.decode(encoded)
 
     DefaultSerializer = JsonPickle
 
@@ -250,23 +437,17 @@ else:
             {'12345': datetime.datetime(1, 2, 3, 4, 5)}
         '''
 
+        @_measured
         def encode(self, obj):
             ''' Encode object to serialized form '''
 
-            with elapsed_time() as et:
-                encoded = zpickle.dumps(obj)
-            log('ZodbPickle.encode elapsed time: %s' % et.timedelta())
-            return encoded
-
+            return zpickle.dumps(obj)
 
+        @_measured
         def decode(self, encoded):
             ''' Decode object from serialized form '''
 
-            log('decoding with ZodbPickle')
-            with elapsed_time() as et:
-                decoded = zpickle.loads(encoded)
-            log('ZodbPickle decode elapsed time: %s' % et.timedelta())
-            return decoded
+            return zpickle.loads(encoded)
 
     DefaultSerializer = ZodbPickle
 
@@ -283,56 +464,278 @@ else:
             Gets error "A dict with references to itself is not JSON encodable".
         '''
 
+        @_measured
         def encode(self, obj):
             ''' Encode object to serialized form '''
 
-            with elapsed_time() as et:
-                encoded = jspickle.encode(obj)
-            log('JsPickle.encode elapsed time: %s' % et.timedelta())
-            return encoded
-
+            return jspickle.encode(obj)
 
+        @_measured
         def decode(self, encoded):
             ''' Decode object from serialized form '''
 
-            log('decoding with JsPickle')
-            with elapsed_time() as et:
-                decoded = jspickle.decode(encoded)
-            log('JsPickle decode elapsed time: %s' % et.timedelta())
-            return decoded
+            return jspickle.decode(encoded)
 
     DefaultSerializer = JsPickle
 
+# a token in the text from syr.format.pretty(), with any space before it:
+# punctuation, a string, a number, or a name
+_LITERAL_TOKEN = re.compile(r'''\s*(?:
+    [{}\[\](),:=]
+  | [uUbB]?[rR]?(?:'[^'\\\n]*(?:\\.[^'\\\n]*)*'|"[^"\\\n]*(?:\\.[^"\\\n]*)*")
+  | [-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?[lLjJ]?
+  | [A-Za-z_][\w.]*
+  )''', re.VERBOSE)
+
+_QUOTES = '\'"'
+_NUMBER_START = '0123456789-+.'
+
+_LITERAL_NAMES = {
+    'None': None,
+    'True': True,
+    'False': False,
+    }
+
+_LITERAL_CONSTRUCTORS = {
+    'datetime.datetime': datetime.datetime,
+    'datetime.date': datetime.date,
+    'datetime.time': datetime.time,
+    'datetime.timedelta': datetime.timedelta,
+    }
+
+if hasattr(datetime, 'timezone'):
+    _LITERAL_NAMES['datetime.timezone.utc'] = datetime.timezone.utc
+    _LITERAL_CONSTRUCTORS['datetime.timezone'] = datetime.timezone
+
+def parse_literal(text):
+    ''' Parse the text of syr.format.pretty(dictify(obj)).
+
+        A safe and faster replacement for eval(text). It only accepts
+        dicts, lists, tuples, strings, bytes, numbers, None, True, False,
+        and the datetime.datetime(), date(), time(), timedelta(), and
+        timezone() constructors. Anything else raises ValueError, so the
+        text can come from an untrusted source.
+
+        >>> print(parse_literal("{'a': [1, -2.5, ('x', None)], 'b': {'c': True}}") ==
+        ...       {'a': [1, -2.5, ('x', None)], 'b': {'c': True}})
+        True
+        >>> parse_literal("datetime.timedelta(days=1, seconds=2)") == datetime.timedelta(1, 2)
+        True
+        >>> parse_literal("('split '\\n 'string')") == 'split string'
+        True
+        >>> parse_literal("os.system('ls')")
+        Traceback (most recent call last):
+        ...
+        ValueError: not allowed in a literal: os.system
+    '''
+
+    tokens = _LITERAL_TOKEN.findall(text)
+
+    # findall() skips text that isn't a token, so make sure none was skipped
+    if ''.join(tokens) != text.rstrip():
+        raise ValueError('unexpected text in literal')
+
+    tokens = [token.lstrip() for token in tokens]
+    # an empty token marks the end, so the parser never runs out of tokens
+    tokens.append('')
+
+    try:
+        value, index = _parse_value(tokens, 0)
+    except (TypeError, RuntimeError) as exc:
+        # e.g. an unhashable dict key, or too deeply nested
+        raise ValueError('bad literal: {}'.format(exc))
+
+    if tokens[index]:
+        raise ValueError('unexpected {!r} after literal'.format(tokens[index]))
+    return value
+
+def _parse_value(tokens, index):
+    ''' Parse the value starting at tokens[index].
+
+        Returns (value, index of the next token). '''
+
+    token = tokens[index]
+    index += 1
+    if not token:
+        raise ValueError('literal ends too soon')
+
+    first = token[0]
+
+    if first == '{':
+        value = {}
+        token = tokens[index]
+        while token != '}':
+            key, index = _parse_value(tokens, index)
+            if tokens[index] != ':':
+                raise ValueError("expected ':' in dict")
+            value[key], index = _parse_value(tokens, index + 1)
+            token = tokens[index]
+            if token == ',':
+                index += 1
+                token = tokens[index]
+            elif token != '}':
+                raise ValueError("expected ',' or '}}' in dict, got {!r}".format(token))
+        index += 1
+
+    elif first == '[':
+        value = []
+        token = tokens[index]
+        while token != ']':
+            item, index = _parse_value(tokens, index)
+            value.append(item)
+            token = tokens[index]
+            if token == ',':
+                index += 1
+                token = tokens[index]
+            elif token != ']':
+                raise ValueError("expected ',' or ']' in list, got {!r}".format(token))
+        index += 1
+
+    elif first == '(':
+        items = []
+        is_tuple = False
+        token = tokens[index]
+        while token != ')':
+            item, index = _parse_value(tokens, index)
+            items.append(item)
+            token = tokens[index]
+            if token == ',':
+                is_tuple = True
+                index += 1
+                token = tokens[index]
+            elif token != ')':
+                raise ValueError("expected ',' or ')' in tuple, got {!r}".format(token))
+        index += 1
+        if is_tuple or not items:
+            value = tuple(items)
+        else:
+            # just parentheses, e.g. around a long string
+            value = items[0]
+
+    elif token[-1] in _QUOTES:
+        value = _parse_string(token)
+        # adjacent strings are joined
+        while tokens[index][-1:] in ('"', "'"):
+            value += _parse_string(tokens[index])
+            index += 1
+
+    elif first in _NUMBER_START:
+        if token[-1] in 'lL':
+            token = token[:-1]
+        if token[-1] in 'jJ':
+            value = complex(token)
+        elif '.' in token or 'e' in token or 'E' in token:
+            value = float(token)
+        else:
+            value = int(token)
+
+    elif token in _LITERAL_NAMES:
+        value = _LITERAL_NAMES[token]
+
+    elif token in _LITERAL_CONSTRUCTORS:
+        name = token
+        if tokens[index] != '(':
+            raise ValueError("expected '(' after {}".format(name))
+        index += 1
+        args = []
+        kwargs = {}
+        token = tokens[index]
+        while token != ')':
+            if tokens[index + 1] == '=' and token[:1].isalpha():
+                kwargs[token], index = _parse_value(tokens, index + 2)
+            else:
+                arg, index = _parse_value(tokens, index)
+                args.append(arg)
+            token = tokens[index]
+            if token == ',':
+                index += 1
+                token = tokens[index]
+            elif token != ')':
+                raise ValueError("expected ',' or ')' after {} arg, got {!r}".format(name, token))
+        index += 1
+        try:
+            value = _LITERAL_CONSTRUCTORS[name](*args, **kwargs)
+        except (TypeError, ValueError, OverflowError) as exc:
+            raise ValueError('bad {}: {}'.format(name, exc))
+
+    elif first.isalpha() or first == '_':
+        raise ValueError('not allowed in a literal: {}'.format(token))
+
+    else:
+        raise ValueError('unexpected {!r}'.format(token))
+
+    return value, index
+
+def _parse_string(token):
+    ''' Return the value of a string or bytes token. '''
+
+    prefix_length = 0
+    while token[prefix_length] not in _QUOTES:
+        prefix_length += 1
+    body = token[prefix_length + 1:-1]
+
+    if '\\' in body:
+        # escapes are rare, so let the python parser handle them
+        return ast.literal_eval(token)
+    elif 'b' in token[:prefix_length].lower():
+        return body.encode('ascii')
+    else:
+        return body
+
+def benchmark_parse_literal(repeat=100):
+    ''' Time decoding a pretty() dict with parse_literal(), eval(), and
+        ast.literal_eval().
+
+        ast.literal_eval() can't decode datetimes, so the payload has
+        none. Returns a dict of seconds per decode by decoder name.
+
+        >>> results = benchmark_parse_literal(repeat=2)
+        >>> sorted(results)
+        ['ast.literal_eval', 'eval', 'parse_literal']
+    '''
+
+    payload = {
+        'id': 12345,
+        'name': 'example',
+        'scores': [1.5, 2.25, -3.0] * 10,
+        'tags': ['alpha', 'beta', "it's"] * 10,
+        'nested': dict(('key{}'.format(i), {'n': i, 'ok': i % 2 == 0, 'pair': (i, None)})
+                       for i in range(50)),
+        }
+    text = pretty(payload, indent=4)
+    decoders = (
+        ('parse_literal', parse_literal),
+        ('eval', eval),
+        ('ast.literal_eval', ast.literal_eval),
+        )
+
+    results = {}
+    for name, decoder in decoders:
+        assert decoder(text) == payload
+        start = time.time()
+        for i in range(repeat):
+            decoder(text)
+        results[name] = (time.time() - start) / repeat
+
+    return results
+
 class Dictify(AbstractSerializer):
-    ''' syr.dict.dictify serializer '''
+    ''' syr.dict.dictify serializer
+
+        decode() parses with parse_literal(), not eval(), so it is safe
+        with untrusted text. '''
 
+    @_measured
     def encode(self, obj, json_compatible=False):
         ''' Encode object to serialized form '''
 
-        #log('Dictify.encode obj: %s' % obj)
-        with elapsed_time() as et:
-            encoded = dictify(obj, deep=True, json_compatible=json_compatible)
-            #log('Dictify.encode encoded: %s' % encoded)
-        log('Dictify.encode elapsed time: %s' % et.timedelta())
-        with tempfile.NamedTemporaryFile( #DEBUG
-            prefix='dictify_serializer.', suffix='.dict', delete=False #DEBUG
-            ) as debug_store: #DEBUG
-            pretty_encoded = pretty(encoded, indent=4)
-            # log('Dictify.encode pretty_encoded: %s' % pretty_encoded)
-            debug_store.write(pretty_encoded) #DEBUG
-            os.chmod(debug_store.name, 0o664) #DEBUG
-            log('Dictify.encode saved to %s' % debug_store.name) #DEBUG
-        return encoded
-
+        return dictify(obj, deep=True, json_compatible=json_compatible)
 
+    @_measured
     def decode(self, encoded):
         ''' Decode object from serialized form '''
 
-        log('decoding with Dictify')
-        with elapsed_time() as et:
-            decoded = eval(encoded)
-        log('Dictify.decode elapsed time: %s' % et.timedelta())
-        return decoded
+        return parse_literal(encoded)
 
     def write(self, openfile, obj):
         ''' Write object to open file.
@@ -342,6 +745,16 @@ class Dictify(AbstractSerializer):
         encoded = self.encode(obj)
         openfile.write(pretty(encoded, indent=4))
 
+    def _encode_frame(self, obj):
+        ''' Encode an object for one frame of a stream. Returns bytes. '''
+
+        return pretty(self.encode(obj)).encode('utf-8')
+
+    def _decode_frame(self, data):
+        ''' Decode an object from one frame of a stream. '''
+
+        return self.decode(data.decode('utf-8'))
+
 DefaultSerializer = Dictify
 
 try:
@@ -357,7 +770,23 @@ else:
 
             This serializer uses the json module, which can only serialize
             data types in the current scope. E.g. if you want to serialize
-            datetime, import datetime in this module. '''
+            datetime, import datetime in this module.
+
+            Streams are JSON Lines, one compact json object per line.
+
+            >>> import io
+            >>> stream = io.StringIO()
+            >>> Json().write_stream(stream, [{'a': 1}, [2, 3]])
+            >>> print(stream.getvalue().strip())
+            {"a": 1}
+            [2, 3]
+            >>> stream.seek(0)
+            0
+            >>> list(Json().read_stream(stream))
+            [{'a': 1}, [2, 3]]
+            '''
+
+        stream_mode = 't'
 
         class ExtendedEncoder(json.JSONEncoder):
             ''' Default to json.JSONEncoder with a fallback to dictify(obj). '''
@@ -374,14 +803,12 @@ else:
                 return result
 
 
+        @_measured
         def encode(self, obj):
             ''' Encode object to serialized form '''
 
-            with elapsed_time() as et:
-                json_object = json.dumps(obj, cls=Json.ExtendedEncoder)
-                encoded = pretty_json(json_object)
-            log('Json.encode elapsed time: %s' % et.timedelta())
-            return encoded
+            json_object = json.dumps(obj, cls=Json.ExtendedEncoder)
+            return pretty_json(json_object)
 
 
         def write(self, openfile, obj):
@@ -391,15 +818,38 @@ else:
 
             json.dump(obj, openfile)
 
+        @_measured
         def decode(self, encoded):
             ''' Decode object from serialized form '''
 
-            log('decoding with Json')
-            with elapsed_time() as et:
-                #decoded = DictObject(json.loads(encoded))
-                decoded = json.loads(encoded)
-            log('Json decode elapsed time: %s' % et.timedelta())
-            return decoded
+            #return DictObject(json.loads(encoded))
+            return json.loads(encoded)
+
+        def write_stream(self, openfile, objects):
+            ''' Write each object from an iterable to an open file as JSON Lines.
+
+                Use tostream() to serialize to a named file. '''
+
+            encoder = Json.ExtendedEncoder()
+            for obj in objects:
+                openfile.write(encoder.encode(self._jsonable(obj)))
+                openfile.write('\n')
+
+        def read_stream(self, openfile):
+            ''' Yield each object from an open JSON Lines file.
+
+                Use fromstream() to deserialize from a named file. '''
+
+            decoder = json.JSONDecoder()
+            for line in openfile:
+                line = line.strip()
+                if line:
+                    yield decoder.decode(line)
+
+        def _jsonable(self, obj):
+            ''' Return obj in a form json can encode. '''
+
+            return obj
 
     DefaultSerializer = Json
 
@@ -412,29 +862,23 @@ class JsonWithDictify(Json):
 
     import sys
     if sys.version < '2.6':
+        @_measured
         def decode(self, encoded):
             ''' Decode object from serialized form '''
 
-            log('decoding with JsonWithDictify')
-            with elapsed_time() as et:
-                # first decode using json
-                json_decoded = json.loads(encoded)
-                # next, turn the names in the dictionary into strings instead of unicode
-                decoded = Dictify().encode(json_decoded, json_compatible=True)
-            log('JsonWithDictify.decode elapsed time: %s' % et.timedelta())
-            return decoded
+            # first decode using json
+            json_decoded = json.loads(encoded)
+            # next, turn the names in the dictionary into strings instead of unicode
+            return Dictify().encode(json_decoded, json_compatible=True)
 
 
+    @_measured
     def encode(self, obj):
         ''' Encode object to serialized form '''
 
-        with elapsed_time() as et:
-            dictified = Dictify().encode(obj, json_compatible=True)
-            # log('JsonWithDictify.encode dictified: %s' % dictified)
-            encoded = Json().encode(dictified)
-            # log('JsonWithDictify.encode encoded: %s' % encoded)
-        log('JsonWithDictify.encode elapsed time: %s' % et.timedelta())
-        return encoded
+        dictified = dictify(obj, deep=True, json_compatible=True)
+        json_object = json.dumps(dictified, cls=Json.ExtendedEncoder)
+        return pretty_json(json_object)
 
     def write(self, openfile, obj):
         ''' Write object to open file.  '''
@@ -443,7 +887,462 @@ class JsonWithDictify(Json):
         # log('JsonWithDictify.write encoded: %s' % encoded)
         openfile.write(encoded)
 
+    def _jsonable(self, obj):
+        ''' Return obj in a form json can encode. '''
+
+        return dictify(obj, deep=True, json_compatible=True)
+
+
+
+try:
+    import lz4.frame
+
+except ImportError:
+    lz4 = None
+
+# Binary extension type codes
+_EXT_DATETIME = 1
+_EXT_DATE = 2
+_EXT_TIME = 3
+_EXT_TIMEDELTA = 4
+_EXT_TUPLE = 5
+_EXT_DICT_OBJECT = 6
+_EXT_BIG_INT = 7
+
+_DATETIME = struct.Struct('>HBBBBBI')
+_DATE = struct.Struct('>HBB')
+_TIME = struct.Struct('>BBBI')
+_TIMEDELTA = struct.Struct('>iiI')
+_UTC_OFFSET = struct.Struct('>i')
+
+# first byte of Binary output
+_UNCOMPRESSED = b'\x00'
+_ZLIB = b'\x01'
+_LZ4 = b'\x02'
+
+if hasattr(datetime, 'timezone'):
+    def _fixed_timezone(seconds):
+        ''' Return a tzinfo for a fixed utc offset in seconds. '''
+
+        return datetime.timezone(datetime.timedelta(seconds=seconds))
+
+else:
+    class _fixed_timezone(datetime.tzinfo):
+        ''' A tzinfo for a fixed utc offset in seconds.
+
+            Python 2 has no datetime.timezone. '''
+
+        def __init__(self, seconds):
+            self.offset = datetime.timedelta(seconds=seconds)
+
+        def utcoffset(self, dt):
+            return self.offset
+
+        def dst(self, dt):
+            return datetime.timedelta(0)
+
+        def tzname(self, dt):
+            return None
+
+try:
+    import msgpack
+
+except ImportError:
+    pass
+
+else:
+    class Binary(AbstractSerializer):
+        ''' Compact binary serializer using msgpack.
+
+            Adds msgpack extension types for datetime, date, time,
+            timedelta, tuple, DictObject, and ints too big for 64 bits.
+            Subclasses of str, int, float, bytes, list, and dict, such as
+            an IntEnum, are encoded as the base type. Other objects are
+            encoded as dictify(obj). Encoded objects are usually much
+            smaller than pickle or json, so Binary suits caches shared
+            between processes.
+
+            A datetime or time with a tzinfo decodes with a fixed offset
+            tzinfo, not the original tzinfo.
+
+            'compress' is None, 'zlib', or 'lz4' if the lz4 module is installed.
+            Compression costs time, and only pays for larger objects. The
+            first byte of the output says how it is compressed, so decode()
+            reads any Binary output whatever 'compress' is.
+
+            >>> serializer = Binary()
+            >>> obj = {'n': [1, -2, 3.5, 2 ** 70], 'when': datetime.date(2016, 5, 27), 'pair': ('a', b'b')}
+            >>> serializer.decode(serializer.encode(obj)) == obj
+            True
+            >>> class Count(int):
+            ...     pass
+            >>> serializer.decode(serializer.encode([Count(3)]))
+            [3]
+            >>> text = ['the same text'] * 100
+            >>> len(Binary(compress='zlib').encode(text)) < len(Binary().encode(text))
+            True
+        '''
+
+        def __init__(self, compress=None, level=6):
+            if compress not in (None, 'zlib', 'lz4'):
+                raise ValueError('unknown compression: {}'.format(compress))
+            if compress == 'lz4' and lz4 is None:
+                raise ValueError('lz4 compression needs the lz4 module')
+            self.compress = compress
+            self.level = level
+
+        @_measured
+        def encode(self, obj):
+            ''' Encode object to serialized form '''
+
+            data = _binary_pack(obj)
+
+            if self.compress == 'zlib':
+                return _ZLIB + zlib.compress(data, self.level)
+            elif self.compress == 'lz4':
+                return _LZ4 + lz4.frame.compress(data)
+            else:
+                return _UNCOMPRESSED + data
+
+        @_measured
+        def decode(self, encoded):
+            ''' Decode object from serialized form '''
+
+            header = encoded[:1]
+            data = encoded[1:]
+            if header == _ZLIB:
+                data = zlib.decompress(data)
+            elif header == _LZ4:
+                if lz4 is None:
+                    raise ValueError('lz4 compressed data needs the lz4 module')
+                data = lz4.frame.decompress(data)
+            elif header != _UNCOMPRESSED:
+                raise ValueError('not Binary serializer output')
+
+            try:
+                return _binary_unpack(data)
+            except msgpack.ExtraData:
+                raise ValueError('extra data after object')
+
+        def read(self, openfile):
+            ''' Read object from open file. The file must be opened in binary mode. '''
+
+            return self.decode(openfile.read())
+
+        def fromfile(self, filename):
+            ''' Read object from file. '''
+
+            with open(filename, 'rb') as infile:
+                decoded = self.read(infile)
+            return decoded
+
+        def tofile(self, filename, obj):
+            ''' Write object to file. '''
+
+            with open(filename, 'wb') as outfile:
+                self.write(outfile, obj)
+
+    def _binary_pack(obj):
+        ''' Return the msgpack encoding of obj. '''
+
+        # strict_types sends tuples and subclasses to _binary_default()
+        return msgpack.packb(obj, default=_binary_default, use_bin_type=True, strict_types=True)
+
+    def _binary_unpack(data):
+        ''' Return the object decoded from msgpack data. '''
+
+        return msgpack.unpackb(data, ext_hook=_binary_ext_hook, raw=False, strict_map_key=False)
+
+    def _binary_default(obj):
+        ''' Return an object msgpack can encode in place of obj. '''
+
+        if isinstance(obj, tuple):
+            return msgpack.ExtType(_EXT_TUPLE, _binary_pack(list(obj)))
+
+        elif isinstance(obj, datetime.datetime):
+            data = _DATETIME.pack(obj.year, obj.month, obj.day,
+                                  obj.hour, obj.minute, obj.second, obj.microsecond)
+            return msgpack.ExtType(_EXT_DATETIME, data + _utc_offset(obj))
+
+        elif isinstance(obj, datetime.date):
+            return msgpack.ExtType(_EXT_DATE, _DATE.pack(obj.year, obj.month, obj.day))
+
+        elif isinstance(obj, datetime.time):
+            data = _TIME.pack(obj.hour, obj.minute, obj.second, obj.microsecond)
+            return msgpack.ExtType(_EXT_TIME, data + _utc_offset(obj))
+
+        elif isinstance(obj, datetime.timedelta):
+            data = _TIMEDELTA.pack(obj.days, obj.seconds, obj.microseconds)
+            return msgpack.ExtType(_EXT_TIMEDELTA, data)
+
+        elif isinstance(obj, DictObject):
+            return msgpack.ExtType(_EXT_DICT_OBJECT, _binary_pack(dict(obj)))
+
+        elif isinstance(obj, int) or (IS_PY2 and isinstance(obj, long)):
+            if -0x8000000000000000 <= obj < 0x10000000000000000:
+                return int(obj)
+            else:
+                return msgpack.ExtType(_EXT_BIG_INT, str(int(obj)).encode('ascii'))
+
+        elif isinstance(obj, float):
+            return float(obj)
+
+        elif IS_PY2 and isinstance(obj, unicode):
+            return unicode(obj)
+
+        elif isinstance(obj, str):
+            return str(obj)
+
+        elif isinstance(obj, (bytes, bytearray)):
+            return bytes(obj)
+
+        elif isinstance(obj, dict):
+            return dict(obj)
+
+        elif isinstance(obj, list):
+            return list(obj)
+
+        else:
+            return dictify(obj, deep=True)
+
+    def _binary_ext_hook(code, data):
+        ''' Return the object for a Binary extension type. '''
+
+        if code == _EXT_DATETIME:
+            fields = _DATETIME.unpack_from(data)
+            return datetime.datetime(*fields, tzinfo=_timezone(data, _DATETIME.size))
+        elif code == _EXT_DATE:
+            return datetime.date(*_DATE.unpack_from(data))
+        elif code == _EXT_TIME:
+            fields = _TIME.unpack_from(data)
+            return datetime.time(*fields, tzinfo=_timezone(data, _TIME.size))
+        elif code == _EXT_TIMEDELTA:
+            return datetime.timedelta(*_TIMEDELTA.unpack_from(data))
+        elif code == _EXT_TUPLE:
+            return tuple(_binary_unpack(data))
+        elif code == _EXT_DICT_OBJECT:
+            return DictObject(_binary_unpack(data))
+        elif code == _EXT_BIG_INT:
+            return int(data.decode('ascii'))
+        else:
+            raise ValueError('unknown Binary extension type {}'.format(code))
+
+def _utc_offset(obj):
+    ''' Return the packed utc offset of a datetime or time, or b'' if it has none. '''
+
+    offset = obj.utcoffset()
+    if offset is None:
+        return b''
+    else:
+        return _UTC_OFFSET.pack(offset.days * 86400 + offset.seconds)
+
+def _timezone(data, offset_start):
+    ''' Return the tzinfo for a packed utc offset, or None. '''
+
+    if len(data) > offset_start:
+        seconds, = _UTC_OFFSET.unpack_from(data, offset_start)
+        return _fixed_timezone(seconds)
+    else:
+        return None
+
+def available_serializers():
+    ''' Return a dict of an instance of each serializer in this module, by name.
+
+        Serializers that need a module that isn't installed are not included. '''
+
+    serializers = {}
+    for name in ('BuiltinPickle', 'JsonPickle', 'ZodbPickle', 'JsPickle',
+                 'Dictify', 'Json', 'JsonWithDictify', 'Binary'):
+        if name in globals():
+            serializers[name] = globals()[name]()
+    if 'Binary' in serializers:
+        serializers['Binary zlib'] = Binary(compress='zlib')
+        if lz4 is not None:
+            serializers['Binary lz4'] = Binary(compress='lz4')
+    return serializers
+
+def benchmark_payloads():
+    ''' Return a dict of representative objects to serialize, by name. '''
+
+    start = datetime.datetime(2016, 5, 27, 12, 30)
+    records = [{
+        'id': i,
+        'name': 'user{}'.format(i),
+        'email': 'user{}@example.com'.format(i),
+        'score': i * 1.5,
+        'active': i % 3 != 0,
+        'created': start + datetime.timedelta(minutes=i),
+        'tags': ['tag{}'.format(i % 7), 'tag{}'.format(i % 11)],
+        } for i in range(200)]
+
+    return {
+        'small dict': {'id': 1, 'name': 'example', 'ok': True, 'score': 2.5},
+        'records': records,
+        'numbers': list(range(-500, 500)) + [i / 7.0 for i in range(1000)],
+        'text': {'body': 'The quick brown fox jumps over the lazy dog. ' * 200},
+        'dates': [start + datetime.timedelta(hours=i) for i in range(500)],
+        }
+
+def benchmark_serializers(serializers=None, payloads=None, repeat=20, frames=True):
+    ''' Measure the size and speed of serializers.
+
+        'serializers' is a dict of serializers by name, by default
+        available_serializers(). 'payloads' is a dict of objects by name,
+        by default benchmark_payloads().
+
+        Returns a list of dicts, one per serializer and payload, with
+        'serializer', 'payload', 'size' in bytes, 'encode_seconds' and
+        'decode_seconds' per call, and 'fidelity', which is True if the
+        decoded object is the same as the payload. See same_object(). If
+        the serializer fails on the payload, 'error' is the exception and
+        the other values are None.
+
+        Streams are how each serializer writes objects to files, so by
+        default this times _encode_frame() and _decode_frame(), which
+        return and take bytes. If 'frames' is False, it times encode()
+        and decode() instead.
+
+        >>> results = benchmark_serializers({'pickle': BuiltinPickle()}, {'small': {'a': 1}}, repeat=1)
+        >>> results[0]['fidelity'], results[0]['error']
+        (True, None)
+    '''
+
+    if serializers is None:
+        serializers = available_serializers()
+    if payloads is None:
+        payloads = benchmark_payloads()
+
+    results = []
+    for serializer_name, serializer in sorted(serializers.items()):
+        if frames:
+            encode = serializer._encode_frame
+            decode = serializer._decode_frame
+        else:
+            encode = serializer.encode
+            decode = serializer.decode
+
+        for payload_name, payload in sorted(payloads.items()):
+            result = {
+                'serializer': serializer_name,
+                'payload': payload_name,
+                'size': None,
+                'encode_seconds': None,
+                'decode_seconds': None,
+                'fidelity': None,
+                'error': None,
+                }
+            try:
+                start = time.time()
+                for i in range(repeat):
+                    encoded = encode(payload)
+                result['encode_seconds'] = (time.time() - start) / repeat
+                result['size'] = len(encoded)
+
+                start = time.time()
+                for i in range(repeat):
+                    decoded = decode(encoded)
+                result['decode_seconds'] = (time.time() - start) / repeat
+                result['fidelity'] = same_object(payload, decoded)
+            except Exception as exc:
+                result['error'] = exc
+            results.append(result)
+
+    return results
+
+def benchmark_report(results):
+    ''' Return results from benchmark_serializers() as a string, one line each.
+
+        MB/s is megabytes of encoded output per second of encode plus decode. '''
+
+    lines = ['{:<16} {:<12} {:>9} {:>11} {:>11} {:>10}  {}'.format(
+        'serializer', 'payload', 'bytes', 'encode ms', 'decode ms', 'MB/s', 'fidelity')]
+    for result in results:
+        if result['error'] is None:
+            seconds = result['encode_seconds'] + result['decode_seconds']
+            if seconds:
+                throughput = '{:.1f}'.format(result['size'] / seconds / 1000000)
+            else:
+                throughput = '-'
+            lines.append('{:<16} {:<12} {:>9} {:>11.3f} {:>11.3f} {:>10}  {}'.format(
+                result['serializer'], result['payload'], result['size'],
+                result['encode_seconds'] * 1000, result['decode_seconds'] * 1000,
+                throughput, 'ok' if result['fidelity'] else 'lossy'))
+        else:
+            lines.append('{:<16} {:<12} failed: {}'.format(
+                result['serializer'], result['payload'], type(result['error']).__name__))
+    return '\n'.join(lines)
+
+def same_object(original, decoded):
+    ''' Return True if decoded is the same as the original object.
+
+        Stricter than ==. Types must match, so a tuple that comes back
+        as a list, or a datetime that comes back as a dict, is not the
+        same. Aware datetimes and times must have the same utc offset.
+        Instances of classes that don't define __eq__ are compared by
+        type and attributes.
+
+        >>> same_object({'a': (1, 2)}, {'a': (1, 2)})
+        True
+        >>> same_object({'a': (1, 2)}, {'a': [1, 2]})
+        False
+        >>> same_object(_Test(), _Test())
+        True
+    '''
+
+    if type(original) is not type(decoded):
+        return False
+
+    if isinstance(original, dict):
+        return (len(original) == len(decoded) and
+                all(key in decoded and same_object(value, decoded[key])
+                    for key, value in original.items()))
+
+    elif isinstance(original, (list, tuple)):
+        return (len(original) == len(decoded) and
+                all(same_object(a, b) for a, b in zip(original, decoded)))
+
+    elif isinstance(original, (datetime.datetime, datetime.time)):
+        return (original.replace(tzinfo=None) == decoded.replace(tzinfo=None) and
+                original.utcoffset() == decoded.utcoffset())
+
+    elif isinstance(original, float) and math.isnan(original):
+        return math.isnan(decoded)
+
+    elif hasattr(original, '__dict__') and type(original).__eq__ is object.__eq__:
+        return same_object(vars(original), vars(decoded))
+
+    else:
+        return original == decoded
+
+def choose_serializer(sample, serializers=None, repeat=5):
+    ''' Return the fastest serializer that preserves a sample object.
+
+        The sample should be like the objects you will serialize. Each
+        serializer encodes and decodes the sample 'repeat' times with
+        encode() and decode(). Of the serializers that decode the sample
+        as the same object, the one with the least total time wins. See
+        same_object().
+
+        'serializers' is a dict of serializers by name, by default
+        available_serializers().
+
+        Raises ValueError if no serializer preserves the sample.
+
+        >>> serializer = choose_serializer({'when': datetime.date(2016, 5, 27), 'ids': (1, 2)})
+        >>> serializer.decode(serializer.encode({'ids': (3, 4)}))
+        {'ids': (3, 4)}
+    '''
+
+    if serializers is None:
+        serializers = available_serializers()
+
+    results = benchmark_serializers(serializers, {'sample': sample}, repeat=repeat, frames=False)
+    preserving = [result for result in results if result['fidelity']]
+    if not preserving:
+        raise ValueError('no serializer preserves {}'.format(type(sample).__name__))
 
+    fastest = min(preserving, key=lambda result: result['encode_seconds'] + result['decode_seconds'])
+    return serializers[fastest['serializer']]
 
 DefaultSerializer = JsonWithDictify
 
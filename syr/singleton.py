@@ -15,10 +15,15 @@
     If you need instances of your class in addition to the singleton
     instance, instantiate them using the standard python syntax.
 
-    This module is thread safe.
+    keyed_singleton() keeps one instance for each set of params, and
+    weak_singleton() lets an instance be garbage collected when nothing
+    else refers to it.
+
+    This module is thread safe. Once an instance exists, getting it
+    takes no locks.
 
     Copyright 2010-2016 GoodCrypto
-    Last modified: 2016-06-23
+    Last modified: 2026-10-16
 
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
@@ -29,17 +34,26 @@ import os
 import socket
 import sys
 import threading
+import time
+import weakref
 
 from syr.python import last_exception, last_exception_only
-from syr.utils import synchronized
 from syr.log import get_log
 from syr.lock import locked
 
 IS_PY2 = sys.version_info[0] == 2
 log = get_log()
 
+# locks for creating instances, by key
 _class_locks = {}
+_class_locks_lock = threading.Lock()
+
+# instances by class
 _instances = {}
+# instances by (class, args, kwargs)
+_keyed_instances = {}
+# instances by class, only while something else refers to them
+_weak_instances = weakref.WeakValueDictionary()
 
 def singleton(singleton_class, *args, **kwargs):
     ''' Returns the instance of a singleton class.
@@ -50,41 +64,142 @@ def singleton(singleton_class, *args, **kwargs):
 
         A single instance of the class is created the first time singleton()
         is called with that particular class as singleton_class. The params
-        and kwargs are ignored on subsequent calls.'''
-
-    @synchronized
-    def _get_class_lock():
+        and kwargs are ignored on subsequent calls.
+
+        >>> class Config(object):
+        ...     def __init__(self, path):
+        ...         self.path = path
+        >>> config = singleton(Config, '/etc/example')
+        >>> singleton(Config, '/etc/other') is config
+        True
+        >>> config.path
+        '/etc/example'
+        >>> have_singleton(config)
+        True
+    '''
 
-        global _class_locks
+    return _get_instance(_instances, singleton_class, singleton_class, args, kwargs)
 
-        try:
-            class_lock = _class_locks[singleton_class]
+def keyed_singleton(singleton_class, *args, **kwargs):
+    ''' Returns the instance of a class for these params.
 
-        except:
-            class_lock = threading.Lock()
-            _class_locks[singleton_class] = class_lock
+        Like singleton(), but there is one instance for each different set
+        of params and kwargs. The params and kwarg values must be hashable.
 
-        return class_lock
+        >>> class Connection(object):
+        ...     def __init__(self, host, port=80):
+        ...         self.host = host
+        >>> a = keyed_singleton(Connection, 'a.example.com')
+        >>> keyed_singleton(Connection, 'a.example.com') is a
+        True
+        >>> keyed_singleton(Connection, 'b.example.com') is a
+        False
+    '''
 
+    key = (singleton_class, args, tuple(sorted(kwargs.items())))
+    return _get_instance(_keyed_instances, key, singleton_class, args, kwargs)
+
+def weak_singleton(singleton_class, *args, **kwargs):
+    ''' Returns the instance of a singleton class, if any, without keeping it alive.
+
+        Like singleton(), but the instance can be garbage collected when
+        nothing else refers to it. The next call then creates a new instance.
+        The class must support weak references.
+
+        >>> import gc
+        >>> class Cache(object):
+        ...     pass
+        >>> cache = weak_singleton(Cache)
+        >>> weak_singleton(Cache) is cache
+        True
+        >>> del cache
+        >>> gc.collect() >= 0
+        True
+        >>> Cache in _weak_instances
+        False
+    '''
 
-    global _instances
+    return _get_instance(_weak_instances, singleton_class, singleton_class, args, kwargs)
 
-    class_lock = _get_class_lock()
-    with locked(class_lock):
+def _get_instance(instances, key, singleton_class, args, kwargs):
+    ''' Return instances[key], creating it if needed.
 
-        try:
-            instance = _instances[singleton_class]
+        Double checked: the first get() needs no lock, and almost always
+        finds the instance. Otherwise get the lock for the key and check
+        again, because another thread may have just created it. '''
 
-        except:
-            instance = singleton_class(*args, **kwargs)
-            _instances[singleton_class] = instance
+    instance = instances.get(key)
+    if instance is None:
+        with locked(_get_class_lock(key)):
+            instance = instances.get(key)
+            if instance is None:
+                instance = singleton_class(*args, **kwargs)
+                instances[key] = instance
 
     return instance
 
+def _get_class_lock(key):
+    ''' Return the lock for creating the instance for key. '''
+
+    class_lock = _class_locks.get(key)
+    if class_lock is None:
+        with locked(_class_locks_lock):
+            class_lock = _class_locks.setdefault(key, threading.Lock())
+
+    return class_lock
+
 def have_singleton(instance):
-    ''' Returns whether the instance is from singleton(). '''
+    ''' Returns whether the instance is from singleton(), keyed_singleton(),
+        or weak_singleton(). '''
+
+    for instances in (_instances, _keyed_instances, _weak_instances):
+        for value in list(instances.values()):
+            if value is instance:
+                return True
+
+    return False
+
+def benchmark_singleton(threads=8, lookups=10000):
+    ''' Time concurrent lookups of an existing singleton.
+
+        Compares singleton() with a lookup that takes the class lock every
+        time, as singleton() used to. Returns a dict of total seconds for
+        'lock free' and 'locked'.
+
+        >>> results = benchmark_singleton(threads=2, lookups=1000)
+        >>> sorted(results)
+        ['lock free', 'locked']
+    '''
+
+    class Benchmark(object):
+        pass
+
+    instance = singleton(Benchmark)
+    class_lock = _get_class_lock(Benchmark)
+
+    def lock_free():
+        for i in range(lookups):
+            assert singleton(Benchmark) is instance
+
+    def with_lock():
+        for i in range(lookups):
+            with locked(class_lock):
+                assert _instances[Benchmark] is instance
+
+    results = {}
+    for name, target in (('lock free', lock_free), ('locked', with_lock)):
+        workers = [threading.Thread(target=target) for i in range(threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        results[name] = time.time() - start
+
+    del _instances[Benchmark]
+    del _class_locks[Benchmark]
 
-    return instance in _instances
+    return results
 
 def port_singleton(port):
     ''' Port singleton.